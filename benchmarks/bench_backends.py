@@ -0,0 +1,88 @@
+"""
+Compares the detector backends against the eager float32 model on a fixed
+image set: load time, latency per image and agreement of detected labels.
+
+Run from the project directory with:
+
+    python -m benchmarks.bench_backends --images FOLDER
+
+Label agreement is the mean, over images, of the Jaccard similarity between
+the set of labels a backend detects and the set the eager model detects.
+"""
+import os
+import json
+import time
+import argparse
+
+from flaskr import object_detection as od
+
+REFERENCE_BACKEND = 'eager'
+
+
+def label_agreement(results, reference_results):
+    """
+    Returns the mean Jaccard similarity of the per-image label sets.
+    """
+    similarities = []
+    for (labels, _), (reference_labels, _) in zip(results, reference_results):
+        labels = set(labels)
+        reference_labels = set(reference_labels)
+        union = labels | reference_labels
+        if len(union) == 0:
+            similarities.append(1.0)
+        else:
+            similarities.append(len(labels & reference_labels) / len(union))
+    return sum(similarities) / len(similarities)
+
+
+def run_backend(backend, filenames, repeats):
+    """
+    Loads a backend and runs it over the images, returning its detections and
+    timings. The first pass is a warm-up and is not timed.
+    """
+    timings = od.warm_up_detector(backend)
+    results = od.run_detector(filenames, backend)
+
+    start = time.perf_counter()
+    for i in range(repeats):
+        od.run_detector(filenames, backend)
+    seconds = (time.perf_counter() - start) / repeats
+
+    return results, {
+        'load_seconds' : timings['load_seconds'],
+        'seconds_per_image' : seconds / len(filenames),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--images', required=True, \
+                        help="folder of sample images to use")
+    parser.add_argument('--repeats', type=int, default=3, \
+                        help="number of timed passes over the images")
+    parser.add_argument('--backends', nargs='+', \
+                        default=list(od.BACKENDS.keys()))
+    args = parser.parse_args()
+
+    filenames = sorted(os.path.join(args.images, name) \
+                       for name in os.listdir(args.images))
+
+    # the reference backend runs first so the others can be compared to it
+    backends = [REFERENCE_BACKEND] + [backend for backend in args.backends \
+                                      if backend != REFERENCE_BACKEND]
+
+    report = dict()
+    reference_results = None
+    for backend in backends:
+        results, timings = run_backend(backend, filenames, args.repeats)
+        if reference_results is None:
+            reference_results = results
+        timings['label_agreement'] = label_agreement(results, \
+                                                     reference_results)
+        report[backend] = timings
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Measures the startup and per-request cost of choosing inspiring poems, with
+the dataset CSV parsed on every request (the old behaviour) and with the
+memory-mapped corpus store. The store is converted into a temporary folder,
+so the converted corpus used by the server is left untouched.
+
+Run from the project directory with:
+
+    python -m benchmarks.bench_corpus
+"""
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import pandas as pd
+
+from flaskr import corpus
+
+
+def time_csv_requests(requests):
+    """
+    Returns the mean seconds per request of parsing the CSV and reading 10
+    random poems from it.
+    """
+    start = time.perf_counter()
+    for i in range(requests):
+        df = pd.read_csv(corpus.CSV_PATH)
+        for idx in random.sample(range(len(df)), 10):
+            df['Title'][idx], df['Poem'][idx]
+    return (time.perf_counter() - start) / requests
+
+
+def time_store_requests(poem_corpus, requests):
+    """
+    Returns the mean seconds per request of reading 10 random poems from the
+    corpus store.
+    """
+    start = time.perf_counter()
+    for i in range(requests):
+        for idx in random.sample(range(len(poem_corpus)), 10):
+            poem_corpus.title(idx), poem_corpus.poem(idx)
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        blob_path = os.path.join(folder, 'corpus.blob')
+        offsets_path = os.path.join(folder, 'corpus.offsets.npy')
+        start = time.perf_counter()
+        corpus.build_corpus_blob(blob_path=blob_path, \
+                                 offsets_path=offsets_path)
+        convert_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        poem_corpus = corpus.PoemCorpus(blob_path, offsets_path)
+        load_seconds = time.perf_counter() - start
+        store_seconds = time_store_requests(poem_corpus, args.requests * 100)
+
+    report = {
+        'poems' : len(poem_corpus),
+        'csv' : {
+            'startup_seconds' : 0.0,
+            'seconds_per_request' : time_csv_requests(args.requests),
+        },
+        'store' : {
+            'conversion_seconds' : convert_seconds,
+            'startup_seconds' : load_seconds,
+            'seconds_per_request' : store_seconds,
+        },
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
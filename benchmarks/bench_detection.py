@@ -0,0 +1,113 @@
+"""
+Reports the cold and warm latency of the shared object detection model, and
+the latency and peak memory of detecting objects in 1, 5 and 20 images.
+
+Run from the project directory with:
+
+    python -m benchmarks.bench_detection [--images FOLDER]
+
+Without an images folder, synthetic 4032x3024 photos (a typical phone camera
+resolution) are generated. Each image count runs in a fresh process so that
+the reported peak RSS belongs to that run alone, and with an empty detection
+cache so that every image goes through the detector.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from flaskr import object_detection as od
+
+IMAGE_COUNTS = [1, 5, 20]
+
+
+def make_sample_images(folder, count, source_folder=None):
+    """
+    Fills the folder with the given number of images, copied round-robin
+    from the source folder or generated synthetically.
+    """
+    from PIL import Image
+    import numpy as np
+
+    sources = []
+    if source_folder is not None:
+        sources = sorted(os.path.join(source_folder, name) \
+                         for name in os.listdir(source_folder))
+
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        if len(sources) > 0:
+            source = sources[i % len(sources)]
+            extension = os.path.splitext(source)[1]
+            shutil.copy(source, os.path.join(folder, f"{i}{extension}"))
+        else:
+            pixels = rng.integers(0, 256, (3024, 4032, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(os.path.join(folder, f"{i}.jpg"))
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in megabytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_count(count, source_folder):
+    """
+    Detects objects in the given number of images and returns the timings
+    and peak memory of the run.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        images_folder = os.path.join(folder, 'images')
+        os.makedirs(images_folder)
+        make_sample_images(images_folder, count, source_folder)
+        # the same synthetic images are made every run, so a shared cache
+        # would measure cache hits instead of detection
+        od.configure(cache_folder=os.path.join(folder, 'cache'))
+        od.warm_up_detector()
+        rss_before = peak_rss_mb()
+
+        start = time.perf_counter()
+        od.detect_objects_in_images(images_folder)
+        seconds = time.perf_counter() - start
+
+    return {
+        'images' : count,
+        'seconds' : seconds,
+        'seconds_per_image' : seconds / count,
+        'peak_rss_mb' : peak_rss_mb(),
+        'peak_rss_before_detection_mb' : rss_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--images', help="folder of sample images to use")
+    parser.add_argument('--count', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # child process: measure a single image count
+    if args.count is not None:
+        print(json.dumps(run_count(args.count, args.images)))
+        return
+
+    report = {'warm_up' : od.warm_up_detector(), 'runs' : []}
+    for count in IMAGE_COUNTS:
+        command = [sys.executable, '-m', 'benchmarks.bench_detection', \
+                   '--count', str(count)]
+        if args.images is not None:
+            command += ['--images', args.images]
+        output = subprocess.run(command, check=True, capture_output=True, \
+                                text=True).stdout
+        report['runs'].append(json.loads(output.splitlines()[-1]))
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Compares how vocabulary building and lookups scale with corpus size when the
+generator's word collections are plain lists versus IndexedSets.
+
+Run from the project directory with:
+
+    python -m benchmarks.bench_vocabulary
+
+For each corpus size, a stream of Zipf-distributed tokens (as in natural
+text) is added to the collection with a membership test per token, as
+parse_word does, then the collection answers membership tests and uniform
+random choices, as generation does.
+"""
+import json
+import time
+import random
+import numpy as np
+
+from flaskr.vocabulary import IndexedSet
+
+CORPUS_TOKENS = [10000, 50000, 200000]
+LOOKUPS = 10000
+
+
+def zipf_tokens(count, seed=0):
+    """
+    Returns a list of Zipf-distributed word tokens
+    """
+    rng = np.random.default_rng(seed)
+    return [f"word{rank}" for rank in rng.zipf(1.3, count)]
+
+
+def time_list(tokens, lookups):
+    """
+    Times building and querying a vocabulary stored as a list
+    """
+    start = time.perf_counter()
+    words = []
+    for token in tokens:
+        if token not in words:
+            words.append(token)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for token in lookups:
+        token in words
+        random.choice(words)
+    return len(words), build_seconds, time.perf_counter() - start
+
+
+def time_indexed_set(tokens, lookups):
+    """
+    Times building and querying a vocabulary stored as an IndexedSet
+    """
+    start = time.perf_counter()
+    words = IndexedSet()
+    for token in tokens:
+        words.add(token)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for token in lookups:
+        token in words
+        random.choice(words)
+    return len(words), build_seconds, time.perf_counter() - start
+
+
+def main():
+    report = []
+    for count in CORPUS_TOKENS:
+        tokens = zipf_tokens(count)
+        lookups = zipf_tokens(LOOKUPS, seed=1)
+        vocab_size, list_build, list_lookup = time_list(tokens, lookups)
+        _, set_build, set_lookup = time_indexed_set(tokens, lookups)
+        report.append({
+            'corpus_tokens' : count,
+            'vocabulary_size' : vocab_size,
+            'list_build_seconds' : list_build,
+            'list_lookup_seconds' : list_lookup,
+            'indexed_set_build_seconds' : set_build,
+            'indexed_set_lookup_seconds' : set_lookup,
+        })
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+Times every stage of poem generation, and the whole pipeline end to end, on
+fixed inputs so that runs can be compared with each other.
+
+Run from the project directory with:
+
+    python -m benchmarks.run [--images FOLDER] [--output FILE]
+                             [--compare BASELINE]
+
+Every run uses the same images (synthetic ones generated from a fixed seed
+unless a folder is given), the same slice of corpus rows and the same
+generation seed. Each stage is timed --repeats times. Two extra passes,
+which leave the timings unaffected, record the memory of each stage: one
+samples the resident set size of the process in a background thread, which
+counts every allocation including torch's, and one runs under tracemalloc to
+record the peak Python memory. The report is written as JSON, and with
+--compare each stage's mean time is also printed relative to a previous
+report.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import tracemalloc
+
+import torch
+from flaskr import main as flaskr_main
+from flaskr import object_detection as od
+from flaskr import poem_generator as pg
+from flaskr import workspaces
+from flaskr.rng import BlockRandom
+from .bench_detection import make_sample_images
+
+STAGES = ['detect_objects_in_images', 'parse_poem_csv', \
+          'parse_inspiring_poems', 'generate_poem', 'improve_poem_themes', \
+          'improve_poem_sentiment', 'reformat_poem', 'end_to_end']
+
+
+def rss_bytes():
+    """
+    Returns the current resident set size of the process, or None where it
+    cannot be read from /proc
+    """
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+class RssSampler():
+    """
+    RssSampler reads the resident set size of the process every interval
+    seconds in a background thread, between start() and stop(), and keeps
+    the highest value read.
+    """
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak_bytes = rss_bytes()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, rss_bytes())
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.peak_bytes = max(self.peak_bytes, rss_bytes())
+
+
+class StageTimer():
+    """
+    StageTimer runs pipeline stages and records the seconds each one took.
+    If tracemalloc is running, it also records the peak Python memory each
+    stage allocated on top of what was allocated when it started. With
+    sample_rss, it records the peak resident set size of the process during
+    each stage, and how far it rose above its size when the stage started.
+    """
+    def __init__(self, sample_rss=False):
+        self.sample_rss = sample_rss and rss_bytes() is not None
+        self.seconds = dict() # stage name to seconds
+        self.peak_mb = dict() # stage name to peak traced megabytes
+        self.peak_rss_mb = dict() # stage name to peak resident megabytes
+        self.rss_increase_mb = dict() # stage name to rise of the peak
+
+
+    def run(self, name, func, *args):
+        """
+        Runs one stage and returns its result
+        """
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        if self.sample_rss:
+            sampler = RssSampler()
+            start_rss_bytes = sampler.peak_bytes
+            sampler.start()
+        start = time.perf_counter()
+        result = func(*args)
+        self.seconds[name] = time.perf_counter() - start
+        if self.sample_rss:
+            sampler.stop()
+            self.peak_rss_mb[name] = sampler.peak_bytes / 2**20
+            self.rss_increase_mb[name] = \
+                            (sampler.peak_bytes - start_rss_bytes) / 2**20
+        if tracemalloc.is_tracing():
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            self.peak_mb[name] = (peak_bytes - start_bytes) / 2**20
+        return result
+
+
+def clear_detection_cache(folder):
+    """
+    Empties the detection cache, so that every pass runs the detector
+    """
+    for filename in os.listdir(folder):
+        os.remove(os.path.join(folder, filename))
+    od.configure(cache_folder=folder)
+
+
+def run_pipeline(images_folder, rows, seed, cache_folder, sample_rss=False):
+    """
+    Runs every stage of the pipeline once, in order, on a fresh workspace and
+    generator, and returns the StageTimer of the pass.
+    """
+    timer = StageTimer(sample_rss)
+    workspace = workspaces.get_workspace(workspaces.new_workspace_id())
+
+    clear_detection_cache(cache_folder)
+    themes = timer.run('detect_objects_in_images', \
+                       od.detect_objects_in_images, images_folder) or []
+
+    timer.run('parse_poem_csv', flaskr_main.parse_poem_csv, workspace, 10, \
+              BlockRandom(seed))
+
+    generator = pg.PoemGenerator(seed)
+    generator.read_poem_rows(rows)
+
+    def parse():
+        generator.parse_inspiring_poems()
+        generator.parse_themes(themes)
+    timer.run('parse_inspiring_poems', parse)
+
+    poem = timer.run('generate_poem', generator.generate_poem, 5, themes)
+    poem = timer.run('improve_poem_themes', generator.improve_poem_themes, \
+                     poem)
+
+    # same goals as PoemGenerator.revise_poem
+    avg_pol, avg_sub = generator.evaluate_sentiment(poem)
+    poem = timer.run('improve_poem_sentiment', \
+                     generator.improve_poem_sentiment, poem, \
+                     (avg_pol + 0.01) * 1.05, (avg_sub + 0.01) * 1.05)
+    timer.run('reformat_poem', generator.reformat_poem, poem)
+
+    # the whole request: detection on upload, then generation
+    def end_to_end():
+        clear_detection_cache(cache_folder)
+        workspace.clear()
+        workspace.save_rows(rows)
+        images_bytes = od.read_images(images_folder)
+        workspace.add_image_results(od.detect_image_results(images_bytes))
+        return flaskr_main.main(workspace, 1, None, None, seed)
+    timer.run('end_to_end', end_to_end)
+
+    return timer
+
+
+def summarize(timers, rss_timer, traced_timer):
+    """
+    Returns the per-stage statistics of the timed passes, with the memory
+    recorded by the RSS and traced passes
+    """
+    stages = dict()
+    for name in STAGES:
+        runs = [timer.seconds[name] for timer in timers]
+        stages[name] = {
+            'mean_seconds' : sum(runs) / len(runs),
+            'min_seconds' : min(runs),
+            'max_seconds' : max(runs),
+            'runs' : runs,
+            'peak_rss_mb' : rss_timer.peak_rss_mb.get(name),
+            'peak_rss_increase_mb' : rss_timer.rss_increase_mb.get(name),
+            'peak_traced_mb' : traced_timer.peak_mb[name],
+        }
+    return stages
+
+
+def compare(report, baseline):
+    """
+    Prints each stage's mean time relative to a baseline report
+    """
+    for name in STAGES:
+        if name not in baseline['stages']:
+            continue
+        old = baseline['stages'][name]['mean_seconds']
+        new = report['stages'][name]['mean_seconds']
+        print(f"{name:26} {old:9.4f}s -> {new:9.4f}s " \
+              f"({new / max(old, 1e-9):5.2f}x)", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--images', help="folder of sample images to use")
+    parser.add_argument('--num-images', type=int, default=3)
+    parser.add_argument('--first-row', type=int, default=0, \
+                        help="first of the 10 corpus rows to use")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help="file to write the JSON report to")
+    parser.add_argument('--compare', help="JSON report to compare against")
+    args = parser.parse_args()
+
+    rows = list(range(args.first_row, args.first_row + 10))
+    with tempfile.TemporaryDirectory() as folder:
+        images_folder = os.path.join(folder, 'images')
+        cache_folder = os.path.join(folder, 'cache')
+        os.makedirs(images_folder)
+        os.makedirs(cache_folder)
+        workspaces.configure(root=os.path.join(folder, 'workspaces'))
+        make_sample_images(images_folder, args.num_images, args.images)
+
+        warm_up = od.warm_up_detector()
+        # one untimed pass loads the corpus and the spaCy pipeline
+        run_pipeline(images_folder, rows, args.seed, cache_folder)
+
+        timers = [run_pipeline(images_folder, rows, args.seed, cache_folder) \
+                  for i in range(args.repeats)]
+        rss_timer = run_pipeline(images_folder, rows, args.seed, \
+                                 cache_folder, sample_rss=True)
+        tracemalloc.start()
+        traced_timer = run_pipeline(images_folder, rows, args.seed, \
+                                    cache_folder)
+        tracemalloc.stop()
+
+    report = {
+        'config' : {
+            'images' : args.images or "synthetic",
+            'num_images' : args.num_images,
+            'rows' : rows,
+            'seed' : args.seed,
+            'repeats' : args.repeats,
+            'backend' : od.config['backend'],
+            'python' : platform.python_version(),
+            'torch' : torch.__version__,
+            'cpus' : os.cpu_count(),
+        },
+        'warm_up' : warm_up,
+        'stages' : summarize(timers, rss_timer, traced_timer),
+        'peak_rss_mb' : \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            compare(report, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,241 @@
 from flask import (
-    Flask, render_template, request, jsonify
+    Flask, render_template, request, jsonify, Response, g
 )
 import os
-from werkzeug.utils import secure_filename
-import glob
+import json
+import time
+import queue
+import logging
+import threading
+from contextlib import ExitStack
 from . import main
+from . import jobs
+from . import metrics
+from . import workspaces
+from . import history
+from . import object_detection as od
+from . import poem_generator as pg
+
+logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)
 
-IMAGES_FOLDER = 'flaskr/images'
-app.config['IMAGES_FOLDER'] = IMAGES_FOLDER
-INSPIRING_POEMS_FOLDER = 'flaskr/inspiring_poems'
+# generated poems are stored in this SQLite database; poems stored as files in
+# the generated poems folder by earlier versions are imported when it is made
+app.config['HISTORY_DB'] = os.environ.get('HISTORY_DB', 'flaskr/history.db')
 GENERATED_POEMS_FOLDER = 'flaskr/generated_poems'
 
-# make sure all folders exist
-for folder in [IMAGES_FOLDER, INSPIRING_POEMS_FOLDER, GENERATED_POEMS_FOLDER]:
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+history.configure(path=app.config['HISTORY_DB'], \
+                  text_folder=GENERATED_POEMS_FOLDER)
+
+# each user session gets a private workspace folder for its uploaded images
+# and inspiring poems, removed once unused for WORKSPACE_TTL_SECONDS; the
+# folder must be shared by all workers serving the app
+app.config['WORKSPACES_FOLDER'] = os.environ.get('WORKSPACES_FOLDER', \
+                                                 workspaces.config['root'])
+app.config['WORKSPACE_TTL_SECONDS'] = \
+                        int(os.environ.get('WORKSPACE_TTL_SECONDS', 3600))
+WORKSPACE_COOKIE = 'workspace_id'
+
+workspaces.configure(root=app.config['WORKSPACES_FOLDER'], \
+                     ttl_seconds=app.config['WORKSPACE_TTL_SECONDS'])
+
+# when the server loads the object detection model: 'startup' loads and warms
+# it up before serving, 'background' does so in a separate thread while the
+# server starts, and 'lazy' waits for the first upload
+app.config['DETECTOR_LOAD'] = os.environ.get('DETECTOR_LOAD', 'background')
+# detector model to use: 'eager' (float32 ResNet50), 'quantized' (int8 fully
+# connected layers), 'torchscript' (frozen TorchScript) or 'mobilenet'
+app.config['DETECTOR_BACKEND'] = os.environ.get('DETECTOR_BACKEND', 'eager')
+# uploaded images are shrunk to this longest side before detection and run
+# through the model this many at a time
+app.config['MAX_IMAGE_SIDE'] = int(os.environ.get('MAX_IMAGE_SIDE', 1333))
+app.config['DETECTION_BATCH_SIZE'] = \
+                            int(os.environ.get('DETECTION_BATCH_SIZE', 4))
+# number of threads decoding and preprocessing uploaded images
+app.config['PREPROCESS_WORKERS'] = int(os.environ.get('PREPROCESS_WORKERS', \
+                                          min(4, os.cpu_count() or 1)))
+
+# detection results of previously seen images are kept on disk up to this size
+app.config['DETECTION_CACHE_MB'] = \
+                            int(os.environ.get('DETECTION_CACHE_MB', 64))
+
+# candidate poems generated in parallel per request, keeping the best one, and
+# the wall-clock budget in seconds for generating them; both can be overridden
+# per request with the 'candidates' and 'budget' parameters of /generate, up
+# to the MAX_ values
+app.config['GENERATION_CANDIDATES'] = int(os.environ.get( \
+                        'GENERATION_CANDIDATES', min(4, os.cpu_count() or 1)))
+app.config['GENERATION_BUDGET_SECONDS'] = \
+            float(os.environ.get('GENERATION_BUDGET_SECONDS', 20))
+app.config['MAX_GENERATION_CANDIDATES'] = \
+            int(os.environ.get('MAX_GENERATION_CANDIDATES', 8))
+app.config['MAX_GENERATION_BUDGET_SECONDS'] = \
+            float(os.environ.get('MAX_GENERATION_BUDGET_SECONDS', 60))
+# candidates are generated on this many worker processes, shared by all
+# requests and started with the server; 1 generates them one after another
+app.config['GENERATION_PROCESSES'] = int(os.environ.get( \
+                        'GENERATION_PROCESSES', min(4, os.cpu_count() or 1)))
+
+# most revision steps taken to strengthen the sentiment of each poem
+app.config['MAX_REVISIONS'] = int(os.environ.get('MAX_REVISIONS', 100))
+
+pg.configure(max_revisions=app.config['MAX_REVISIONS'], \
+             max_candidates=app.config['MAX_GENERATION_CANDIDATES'], \
+             max_budget_seconds=app.config['MAX_GENERATION_BUDGET_SECONDS'])
+
+# poems are generated in the background by this many worker threads, with at
+# most this many more /generate requests waiting for a worker
+app.config['GENERATION_WORKERS'] = \
+                            int(os.environ.get('GENERATION_WORKERS', 1))
+app.config['GENERATION_QUEUE_SIZE'] = \
+                            int(os.environ.get('GENERATION_QUEUE_SIZE', 16))
+
+# uploads larger than this are refused, and so are images with more pixels
+# than this, before they are decoded
+app.config['MAX_CONTENT_LENGTH'] = \
+            int(os.environ.get('MAX_UPLOAD_MB', 16)) * 1024 * 1024
+app.config['MAX_IMAGE_PIXELS'] = \
+            int(os.environ.get('MAX_IMAGE_PIXELS', 25000000))
+
+od.configure(backend=app.config['DETECTOR_BACKEND'], \
+             max_image_side=app.config['MAX_IMAGE_SIDE'], \
+             batch_size=app.config['DETECTION_BATCH_SIZE'], \
+             preprocess_workers=app.config['PREPROCESS_WORKERS'], \
+             max_image_pixels=app.config['MAX_IMAGE_PIXELS'], \
+             cache_max_bytes=app.config['DETECTION_CACHE_MB'] * 1024 * 1024)
+
+# requests can be profiled with cProfile into PROFILE_FOLDER: 'off' never
+# profiles, 'header' profiles requests sent with an 'X-Profile: 1' header and
+# 'all' profiles every request; the generation of a poem, queued or streamed,
+# is profiled in its own file
+app.config['PROFILE_REQUESTS'] = os.environ.get('PROFILE_REQUESTS', 'off')
+app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', \
+                                              metrics.config['profile_folder'])
+
+metrics.configure(profile_folder=app.config['PROFILE_FOLDER'])
+
+generation_jobs = jobs.JobQueue(app.config['GENERATION_WORKERS'], \
+                                app.config['GENERATION_QUEUE_SIZE'])
+
+# objects in uploaded images are detected in the background by this many
+# worker threads, with at most this many more uploads waiting for a worker
+app.config['DETECTION_WORKERS'] = int(os.environ.get('DETECTION_WORKERS', 1))
+app.config['DETECTION_QUEUE_SIZE'] = \
+                            int(os.environ.get('DETECTION_QUEUE_SIZE', 16))
+
+detection_jobs = jobs.JobQueue(app.config['DETECTION_WORKERS'], \
+                               app.config['DETECTION_QUEUE_SIZE'])
+
+# streams of queued jobs send a comment this often to stay open
+STREAM_KEEPALIVE_SECONDS = 15
+
+def start_workers():
+    """
+    Starts the candidate workers and loads the detector as configured. Only
+    the server's entry point (flaskr.wsgi) calls this, before any thread is
+    started, so that importing the package, as the offline tools and the
+    benchmarks do, neither loads spaCy nor forks workers.
+    """
+    # the candidate workers are forked first, before any thread is started
+    pg.start_candidate_pool(app.config['GENERATION_PROCESSES'])
+
+    if app.config['DETECTOR_LOAD'] == 'startup':
+        od.warm_up_detector()
+    elif app.config['DETECTOR_LOAD'] == 'background':
+        threading.Thread(target=od.warm_up_detector, daemon=True).start()
+
+def current_workspace():
+    """
+    Returns the workspace of the user session making the request, starting a
+    new one if the request has no valid workspace cookie.
+    """
+    workspace_id = request.cookies.get(WORKSPACE_COOKIE)
+    if not workspaces.is_valid_id(workspace_id):
+        workspace_id = workspaces.new_workspace_id()
+    # the cookie is set on the response by remember_workspace
+    g.workspace_id = workspace_id
+    return workspaces.get_workspace(workspace_id)
+
+@app.after_request
+def remember_workspace(response):
+    """
+    Sets the cookie of the workspace used during the request, so that it
+    expires WORKSPACE_TTL_SECONDS after the last use, like the workspace
+    """
+    if 'workspace_id' in g:
+        response.set_cookie(WORKSPACE_COOKIE, g.workspace_id, \
+                            max_age=app.config['WORKSPACE_TTL_SECONDS'], \
+                            httponly=True, samesite='Lax')
+    return response
 
-# allowed file types for image uploads
-ALLOWED_TYPES = ['jpg', 'jpeg', 'png']
+def wants_profile():
+    """
+    Checks whether the request should be profiled
+    """
+    if app.config['PROFILE_REQUESTS'] == 'all':
+        return True
+    return app.config['PROFILE_REQUESTS'] == 'header' and \
+           request.headers.get('X-Profile') == '1'
+
+@app.before_request
+def start_request_metrics():
+    """
+    Starts timing the request, and profiling it if asked to
+    """
+    g.request_start = time.perf_counter()
+    if wants_profile():
+        g.profile = ExitStack()
+        g.profile.enter_context(metrics.profiled(request.endpoint))
 
-def allowed_file(filename):
+@app.after_request
+def record_request_metrics(response):
     """
-    Checks if the file has an allowed extension
+    Records the time taken to handle the request. Streamed responses are
+    timed until their first byte; their stages are timed as they run.
     """
-    if '.' not in filename:
-        return False
-    name_split = filename.split('.', 1)
-    extension = name_split[1].lower()
-    return extension in ALLOWED_TYPES
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, \
+                                    endpoint=request.endpoint)
+    return response
+
+@app.teardown_request
+def stop_request_profile(error):
+    """
+    Dumps the profile of the request, if it was profiled
+    """
+    if 'profile' in g:
+        g.pop('profile').close()
 
 @app.route("/", methods=["GET"])
 def hello():
     """
     Displays when the user first navigates to the site.
     """
-    # reset the images and inspiring poems folders
-    for filename in glob.glob(f"{IMAGES_FOLDER}/*"): 
-        os.remove(filename)
-    for filename in glob.glob(f"{INSPIRING_POEMS_FOLDER}/*"):
-        os.remove(filename)
+    # reset the images and inspiring poems of this user only
+    workspace = current_workspace()
+    workspace.clear()
 
     # select and parse 10 random poems to be used for this round of generation
-    main.parse_poem_csv()
+    main.parse_poem_csv(workspace)
 
     return render_template('index.html')
 
+@app.errorhandler(413)
+def upload_too_large(error):
+    """
+    Displays when the uploaded files exceed MAX_CONTENT_LENGTH
+    """
+    max_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return render_template('index.html', files_uploaded = \
+                f'Upload too large. Upload at most {max_mb} MB at once.'), 413
+
 @app.route("/upload", methods=['GET', 'POST'])
 def upload_file():
     """
-    Retrieves uploaded image files from the user and stores them in the
-    images folder.
+    Retrieves uploaded image files from the user and queues the detection of
+    the objects in them, whose results are stored in their workspace. Poems
+    generated afterwards wait for the detection to finish. Files are only
+    read into memory and never written to disk.
     """
     if request.method == 'POST':
 
@@ -68,55 +252,220 @@ def upload_file():
             return render_template('index.html', \
                                files_uploaded = 'No file selected. Try again.')
 
-        # if valid files were uploaded
+        # read uploads into memory and keep only valid JPEG and PNG images
+        images_bytes = []
         for file in files:
-            if file and allowed_file(file.filename):
-                # ensures no repeating file names
-                filename = secure_filename(file.filename)
-                # saves uploaded image file to images folder
-                file.save(os.path.join(app.config['IMAGES_FOLDER'], filename))
+            if file:
+                image_bytes = file.read()
+                if od.check_image(image_bytes) is not None:
+                    images_bytes.append(image_bytes)
+        num_skipped = len(files) - len(images_bytes)
+
+        # detect objects straight from memory in the background and keep
+        # only the results
+        if len(images_bytes) > 0:
+            workspace = current_workspace()
+            detection_id = workspace.start_detection()
+            try:
+                detection_jobs.submit(run_detection_job, workspace, \
+                                      detection_id, images_bytes)
+            except queue.Full:
+                workspace.finish_detection(detection_id)
+                return render_template('index.html', files_uploaded = \
+                        'Too many images are being processed. Try again ' \
+                        'shortly.'), 503
+
+        if num_skipped > 0:
+            return render_template('index.html', files_uploaded = \
+                    f'Skipped {num_skipped} file(s) that are not JPEG or PNG ' \
+                    'images or are too large.')
         return render_template('index.html', \
                                files_uploaded = 'Files uploaded successfully!')
     return ''
 
 
+def run_detection_job(job, workspace, detection_id, images_bytes):
+    """
+    Detects the objects in uploaded images for a queued job and stores the
+    results in the workspace, leaving out images that could not be decoded.
+    Returns a dictionary of the number of images detected and skipped.
+    """
+    try:
+        image_results = [result for result in \
+                         od.detect_image_results(images_bytes) \
+                         if result is not None]
+        workspace.add_image_results(image_results)
+    finally:
+        workspace.finish_detection(detection_id)
+    return {'images' : len(image_results), \
+            'skipped' : len(images_bytes) - len(image_results)}
+
+def save_poem(poem_name, new_poem):
+    """
+    Stores a generated poem in the poem history
+    """
+    # don't store anything if no poem generated because of no images
+    if not new_poem == "*NO IMAGES*":
+        history.get_history().add(poem_name, new_poem)
+
+def run_generate_job(job, workspace, num_candidates, budget_seconds, seed, \
+                     profile=False):
+    """
+    Generates a new poem for a queued job, publishing the progress of each
+    stage as job events, stores it in the poem history, and returns a
+    dictionary of the poem name, poem string and the seed it was generated
+    with. The job is profiled if profile is True.
+    """
+    workspace.touch()
+    with ExitStack() as stack:
+        if profile:
+            stack.enter_context(metrics.profiled(f"job-{job.id}"))
+        for event, data in main.generate_events(workspace, num_candidates, \
+                                    budget_seconds, job.stage_seconds, seed):
+            job.publish(event, data)
+            if event == 'poem':
+                save_poem(data['name'], data['poem'])
+                return {'name' : data['name'], 'poem' : data['poem'], \
+                        'seed' : data.get('seed')}
+
+def generation_settings(default_candidates):
+    """
+    Returns the number of candidates, the budget in seconds and the seed asked
+    for by the request, with the candidates and budget capped at their
+    configured maxima, and the seed reduced to the 32-bit range of the seeds
+    handed out, so that any integer is a valid seed
+    """
+    num_candidates = request.values.get('candidates', default_candidates, \
+                                        type=int)
+    budget_seconds = request.values.get('budget', \
+                            app.config['GENERATION_BUDGET_SECONDS'], type=float)
+    num_candidates = min(max(1, num_candidates), \
+                         app.config['MAX_GENERATION_CANDIDATES'])
+    budget_seconds = min(max(0, budget_seconds), \
+                         app.config['MAX_GENERATION_BUDGET_SECONDS'])
+    seed = request.values.get('seed', type=int)
+    if seed is not None:
+        seed %= 2**32
+    return num_candidates, budget_seconds, seed
+
 @app.route('/generate', methods=['POST'])
 def generate_poem():
     """
-    Generates a new poem, stores it in the generated poems folder, and returns
-    a JSON dictionary of the poem name and poem string.
+    Queues the generation of a new poem and returns a JSON dictionary with the
+    job id to poll at /jobs/<id>, and the number of jobs waiting before it.
+    Passing the 'seed' of an earlier poem generates the same poem again.
     """
-    poem_tuple = main.main()
-    poem_name = poem_tuple[0]
-    new_poem = poem_tuple[1]
+    num_candidates, budget_seconds, seed = \
+                generation_settings(app.config['GENERATION_CANDIDATES'])
+    try:
+        job = generation_jobs.submit(run_generate_job, current_workspace(), \
+                                     num_candidates, budget_seconds, seed, \
+                                     wants_profile())
+    except queue.Full:
+        return jsonify({'error' : 'Too many poems are being generated. ' \
+                                  'Try again shortly.'}), 503
 
-    # don't write into file if no poem generated because of no images
-    if not new_poem == "*NO IMAGES*":
-        filename = secure_filename(poem_name)
-        file_path = f'{GENERATED_POEMS_FOLDER}/{filename}.txt'
-        new_file = open(file_path, 'w')
-        new_file.write(new_poem)
-        new_file.close()
-    
-    # creates dictionary to return two JSON pieces of data
-    poem_data = {'name' : poem_name, 'poem' : new_poem}
-
-    return jsonify(poem_data)
-
-@app.route('/history', methods=["POST"])
+    return jsonify({'job_id' : job.id, \
+                    'queue_depth' : generation_jobs.depth()}), 202
+
+@app.route('/generate/stream', methods=['GET'])
+def stream_poem():
+    """
+    Queues the generation of a new poem like /generate, and streams the
+    progress of each stage of the job as Server-Sent Events: first a 'queued'
+    event with the job id and queue depth, and at the end a 'poem' event
+    carrying the poem name and poem string, or a 'failed' event. A single
+    candidate is generated unless the 'candidates' parameter asks for more,
+    so that lines are sent as they are written. Passing the 'seed' of an
+    earlier poem generates the same poem again.
+    """
+    num_candidates, budget_seconds, seed = generation_settings(1)
+    try:
+        job = generation_jobs.submit(run_generate_job, current_workspace(), \
+                                     num_candidates, budget_seconds, seed, \
+                                     wants_profile(), events=True)
+    except queue.Full:
+        return jsonify({'error' : 'Too many poems are being generated. ' \
+                                  'Try again shortly.'}), 503
+
+    def event_stream():
+        data = {'job_id' : job.id, 'queue_depth' : generation_jobs.depth()}
+        yield f"event: queued\ndata: {json.dumps(data)}\n\n"
+        # comments keep the connection open while the job waits for a worker
+        for item in job.subscribe(timeout=STREAM_KEEPALIVE_SECONDS):
+            if item is None:
+                yield ": keepalive\n\n"
+                continue
+            event, data = item
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        if job.status == 'failed':
+            data = {'error' : job.error}
+            yield f"event: failed\ndata: {json.dumps(data)}\n\n"
+
+    return Response(event_stream(), mimetype='text/event-stream', \
+                    headers={'Cache-Control' : 'no-cache', \
+                             'X-Accel-Buffering' : 'no'})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def view_job(job_id):
+    """
+    Returns a JSON dictionary of the status, stage timings and, once done, the
+    result of a generation job, along with the current queue depth.
+    """
+    job = generation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error' : 'Unknown job'}), 404
+
+    job_data = job.to_dict()
+    job_data.update(generation_jobs.stats())
+    return jsonify(job_data)
+
+@app.route('/history', methods=["GET", "POST"])
 def view_old_poems():
     """
-    Returns a dictionary of file name to text for all the poems in the 
-    generated poems folder.
+    Returns a page of previously generated poems, newest first, as a JSON
+    dictionary with the list of poems and the cursor to pass as 'before' for
+    the next page (null on the last page). Pages carry an ETag and
+    Last-Modified date, so unchanged pages are not sent again.
     """
-    path_len = len(GENERATED_POEMS_FOLDER) + 1
-    file_to_poem = dict()
+    before = request.values.get('before', type=int)
+    limit = min(max(1, request.values.get('limit', 20, type=int)), 100)
+    poems, next_cursor = history.get_history().page(before, limit)
 
-    # iterate over all files in the generated poems folder
-    for filename in glob.glob(f"{GENERATED_POEMS_FOLDER}/*"): 
-        poem_file = open(filename)
-        poem_str = poem_file.read()
-        # remove the '.txt' in the file name for the key
-        file_to_poem[filename[path_len:-4]] = poem_str
-        
-    return jsonify(file_to_poem)
+    response = jsonify({'poems' : poems, 'next' : next_cursor})
+    # older pages never change; the first one changes with each new poem
+    if len(poems) > 0:
+        response.set_etag(f"{before}-{limit}-{poems[0]['id']}-" \
+                          f"{poems[-1]['id']}")
+        response.last_modified = poems[0]['created']
+    else:
+        response.set_etag(f"{before}-{limit}-empty")
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/history/count', methods=["GET"])
+def count_old_poems():
+    """
+    Returns a JSON dictionary with the number of previously generated poems
+    """
+    num_poems, newest_id = history.get_history().count()
+    response = jsonify({'count' : num_poems})
+    response.set_etag(f"{num_poems}-{newest_id}")
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/metrics', methods=["GET"])
+def view_metrics():
+    """
+    Returns the timings and counts of the work done by this process in the
+    Prometheus text format
+    """
+    job_stats = generation_jobs.stats()
+    for state in ['queued', 'running']:
+        metrics.GENERATION_JOBS.set(job_stats[state], state=state)
+    job_stats = detection_jobs.stats()
+    for state in ['queued', 'running']:
+        metrics.DETECTION_JOBS.set(job_stats[state], state=state)
+    metrics.PREPROCESS_QUEUE_DEPTH.set(od.preprocess_queue_depth())
+    return Response(metrics.render(), \
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
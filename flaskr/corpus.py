@@ -0,0 +1,147 @@
+import os
+import mmap
+import hashlib
+import time
+import logging
+import threading
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# dataset of inspiring poems and its preconverted form
+CSV_PATH = 'flaskr/PoetryFoundationData.csv'
+BLOB_PATH = 'flaskr/PoetryFoundationData.blob'
+OFFSETS_PATH = 'flaskr/PoetryFoundationData.offsets.npy'
+
+# process-wide corpus, loaded at most once
+_corpus = None
+_corpus_lock = threading.Lock()
+
+
+class PoemCorpus():
+    """
+    PoemCorpus gives random access to the titles and texts of the poems in the
+    dataset. All titles and poems are stored back to back in one UTF-8 blob
+    that is memory-mapped from disk, with an array of byte offsets per row, so
+    loading the corpus does not parse anything and reading a poem only touches
+    the pages it lives on.
+    """
+    def __init__(self, blob_path=None, offsets_path=None):
+        blob_path = blob_path or BLOB_PATH
+        offsets_path = offsets_path or OFFSETS_PATH
+        self.file = open(blob_path, 'rb')
+        self.blob = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        # for every row: start of title, start of poem, end of poem
+        self.offsets = np.load(offsets_path)
+        self._checksum = None # computed on first use
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def title(self, row_id):
+        """
+        Returns the title of the poem at the given row
+        """
+        title_start, poem_start, _ = self.offsets[row_id]
+        return self.blob[title_start:poem_start].decode()
+
+
+    def poem(self, row_id):
+        """
+        Returns the text of the poem at the given row
+        """
+        _, poem_start, poem_end = self.offsets[row_id]
+        return self.blob[poem_start:poem_end].decode()
+
+
+    def checksum(self):
+        """
+        Returns a 64-bit checksum of the titles, poems and offsets, which is
+        the same for every conversion of the same dataset
+        """
+        if self._checksum is None:
+            digest = hashlib.blake2b(self.blob, digest_size=8)
+            digest.update(self.offsets.tobytes())
+            self._checksum = int.from_bytes(digest.digest(), 'little', \
+                                            signed=True)
+        return self._checksum
+
+
+def build_corpus_blob(csv_path=None, blob_path=None, offsets_path=None):
+    """
+    Converts the dataset CSV into the blob and offsets files read by
+    PoemCorpus. Both are written to temporary files and moved into place,
+    offsets last, so that another process starting at the same time never
+    reads a half-written file.
+    """
+    csv_path = csv_path or CSV_PATH
+    blob_path = blob_path or BLOB_PATH
+    offsets_path = offsets_path or OFFSETS_PATH
+    df = pd.read_csv(csv_path)
+    titles = df['Title'].fillna("")
+    poems = df['Poem'].fillna("")
+
+    offsets = np.zeros((len(df), 3), dtype=np.int64)
+    position = 0
+    blob_temp_path = f"{blob_path}.{os.getpid()}.tmp"
+    offsets_temp_path = f"{offsets_path}.{os.getpid()}.tmp"
+    with open(blob_temp_path, 'wb') as blob_file:
+        for row_id in range(len(df)):
+            title_bytes = str(titles.iloc[row_id]).encode()
+            poem_bytes = str(poems.iloc[row_id]).encode()
+            blob_file.write(title_bytes)
+            blob_file.write(poem_bytes)
+            offsets[row_id] = [position, position + len(title_bytes), \
+                        position + len(title_bytes) + len(poem_bytes)]
+            position = offsets[row_id][2]
+    with open(offsets_temp_path, 'wb') as offsets_file:
+        np.save(offsets_file, offsets)
+    os.replace(blob_temp_path, blob_path)
+    os.replace(offsets_temp_path, offsets_path)
+
+
+def is_blob_outdated():
+    """
+    Checks whether the blob files are missing or older than the dataset CSV
+    """
+    for path in [BLOB_PATH, OFFSETS_PATH]:
+        if not os.path.exists(path):
+            return True
+        if os.path.exists(CSV_PATH) and \
+                os.path.getmtime(path) < os.path.getmtime(CSV_PATH):
+            return True
+    return False
+
+
+def corpus_stamp():
+    """
+    Returns the number of poems, the size of the blob and the checksum of the
+    process-wide corpus, which change whenever the poems do, so that files
+    derived from it can tell they are out of date. Converting the same
+    dataset again gives the same stamp.
+    """
+    poem_corpus = get_corpus()
+    return [len(poem_corpus), len(poem_corpus.blob), poem_corpus.checksum()]
+
+
+def get_corpus():
+    """
+    Returns the process-wide corpus, converting the dataset CSV on first use
+    if it has not been converted yet.
+    """
+    global _corpus
+    if _corpus is None:
+        with _corpus_lock:
+            if _corpus is None:
+                start = time.perf_counter()
+                if is_blob_outdated():
+                    build_corpus_blob()
+                    logger.info("Converted %s in %.2fs", CSV_PATH, \
+                                time.perf_counter() - start)
+                _corpus = PoemCorpus()
+                logger.info("Loaded corpus of %d poems in %.3fs", \
+                            len(_corpus), time.perf_counter() - start)
+    return _corpus
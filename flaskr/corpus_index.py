@@ -0,0 +1,149 @@
+"""
+Pre-parsed sentences of every poem in the corpus, so that generation loads
+spaCy docs instead of running the tagger and parser at request time.
+
+Build the index once, after the dataset CSV is in place, with:
+
+    python -m flaskr.corpus_index
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+import numpy as np
+from spacy.tokens import DocBin
+from . import corpus
+from . import nlp_pipeline
+from . import poem_generator as pg
+
+logger = logging.getLogger(__name__)
+
+INDEX_FOLDER = 'flaskr/corpus_index'
+ROWS_FILE = 'rows.npy'
+META_FILE = 'meta.json'
+
+# process-wide index, loaded at most once
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+
+def pipeline_id(nlp):
+    """
+    Returns a string identifying a spaCy pipeline, so that docs parsed by a
+    different model or version are not mixed with live parses.
+    """
+    return f"{nlp.meta['lang']}_{nlp.meta['name']}-{nlp.meta['version']}"
+
+
+def shard_path(folder, shard_id):
+    """
+    Returns the file path of an index shard
+    """
+    return os.path.join(folder, f"shard_{shard_id:05d}.bin")
+
+
+class CorpusIndex():
+    """
+    CorpusIndex reads the pre-parsed sentence docs of a poem by its row id in
+    the corpus. Each poem's docs are serialized as their own DocBin, and the
+    DocBins are stored back to back in shard files, so loading a poem reads
+    and deserializes only that poem's bytes.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        # for every row: shard id, start and end byte (shard id -1 if missing)
+        self.rows = np.load(os.path.join(folder, ROWS_FILE))
+
+
+    def get_docs(self, row_id, vocab):
+        """
+        Returns the list of sentence docs of the poem at the given row, or None
+        if the poem is not in the index.
+        """
+        if row_id >= len(self.rows):
+            return None
+        shard_id, start, end = self.rows[row_id]
+        if shard_id < 0:
+            return None
+        with open(shard_path(self.folder, shard_id), 'rb') as shard:
+            shard.seek(start)
+            data = shard.read(end - start)
+        return list(DocBin().from_bytes(data).get_docs(vocab))
+
+
+def build_index(folder=INDEX_FOLDER, shard_size=500, n_process=1):
+    """
+    Parses every poem in the corpus and writes its sentence docs to the index
+    folder, with shard_size poems per shard file. The poems of each shard are
+    parsed together, spread over n_process processes.
+    """
+    nlp = nlp_pipeline.get_nlp()
+    poem_corpus = corpus.get_corpus()
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    rows = np.full((len(poem_corpus), 3), -1, dtype=np.int64)
+    start_time = time.perf_counter()
+
+    for shard_id in range(0, (len(poem_corpus) + shard_size - 1) // shard_size):
+        first_row = shard_id * shard_size
+        last_row = min(first_row + shard_size, len(poem_corpus))
+        poems_sentence_docs = pg.parse_poem_sentences([poem_corpus.poem(row_id) \
+                    for row_id in range(first_row, last_row)], n_process)
+        position = 0
+        with open(shard_path(folder, shard_id), 'wb') as shard:
+            for row_id, sentence_docs in zip(range(first_row, last_row), \
+                                             poems_sentence_docs):
+                data = DocBin(docs=sentence_docs).to_bytes()
+                shard.write(data)
+                rows[row_id] = [shard_id, position, position + len(data)]
+                position += len(data)
+        logger.info("Indexed %d/%d poems in %.0fs", last_row, \
+                    len(poem_corpus), time.perf_counter() - start_time)
+
+    # rows and meta are written last, so a partial build is never loaded
+    np.save(os.path.join(folder, ROWS_FILE), rows)
+    with open(os.path.join(folder, META_FILE), 'w') as meta_file:
+        json.dump({'pipeline' : pipeline_id(nlp), \
+                   'poems' : len(poem_corpus), \
+                   'corpus' : corpus.corpus_stamp()}, meta_file)
+
+
+def get_index(nlp):
+    """
+    Returns the process-wide corpus index, or None if it has not been built,
+    was built with a different spaCy pipeline than the given one, or was built
+    from a different version of the corpus, whose row ids no longer match.
+    """
+    global _index, _index_loaded
+    with _index_lock:
+        if not _index_loaded:
+            _index_loaded = True
+            meta_path = os.path.join(INDEX_FOLDER, META_FILE)
+            if os.path.exists(meta_path):
+                with open(meta_path) as meta_file:
+                    meta = json.load(meta_file)
+                if meta['pipeline'] != pipeline_id(nlp):
+                    logger.warning("Ignoring corpus index built with %s", \
+                                   meta['pipeline'])
+                elif meta.get('corpus') != corpus.corpus_stamp():
+                    logger.warning("Ignoring corpus index built from an " \
+                                   "older corpus; rebuild it with " \
+                                   "python -m flaskr.corpus_index")
+                else:
+                    _index = CorpusIndex(INDEX_FOLDER)
+        return _index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-parses the corpus.")
+    parser.add_argument('--shard-size', type=int, default=500, \
+                        help="number of poems per shard file")
+    parser.add_argument('--n-process', type=int, default=1, \
+                        help="number of processes parsing poems")
+    args = parser.parse_args()
+
+    build_index(shard_size=args.shard_size, n_process=args.n_process)
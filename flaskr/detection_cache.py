@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def image_key(image_bytes, version):
+    """
+    Returns the cache key of an image: a hash of its bytes together with the
+    version string of the detector settings that produced the results.
+    """
+    hasher = hashlib.sha256(image_bytes)
+    hasher.update(version.encode())
+    return hasher.hexdigest()
+
+
+class DetectionCache():
+    """
+    DetectionCache stores the labels and scores detected in each image, so that
+    images which have been seen before skip object detection entirely. Entries
+    are kept as small JSON files in a folder and the least recently used ones
+    are evicted once the folder grows past the maximum size.
+    """
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key to file size, oldest use first
+        self.total_bytes = 0
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # rebuild the usage order from the files left by earlier processes
+        files = []
+        for filename in os.listdir(folder):
+            if not filename.endswith('.json'):
+                continue
+            stat = os.stat(os.path.join(folder, filename))
+            files.append((stat.st_mtime, filename[:-5], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+
+
+    def path(self, key):
+        """
+        Returns the file path of a cache entry
+        """
+        return os.path.join(self.folder, f"{key}.json")
+
+
+    def get(self, key):
+        """
+        Returns the (labels, scores) lists stored for the key, or None if the
+        image has not been seen before.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            try:
+                with open(self.path(key)) as file:
+                    entry = json.load(file)
+                # mark as most recently used on disk for future processes
+                os.utime(self.path(key))
+            except (OSError, ValueError):
+                # entry removed or corrupted behind our back, e.g. evicted by
+                # another worker
+                self.total_bytes -= self.entries.pop(key)
+                return None
+
+            self.entries.move_to_end(key)
+            return entry['labels'], entry['scores']
+
+
+    def put(self, key, labels, scores):
+        """
+        Stores the labels and scores detected in an image and evicts the least
+        recently used entries if the cache is over its maximum size.
+        """
+        data = json.dumps({'labels' : labels, 'scores' : scores})
+        with self.lock:
+            with open(self.path(key), 'w') as file:
+                file.write(data)
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.remove(self.path(old_key))
+                except OSError:
+                    pass
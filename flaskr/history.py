@@ -0,0 +1,164 @@
+"""
+Store of every generated poem, newest first, read a page at a time.
+
+Poems written as .txt files into the generated poems folder by earlier
+versions are imported when the store is first created, or by hand, skipping
+poems imported before, with:
+
+    python -m flaskr.history
+"""
+import os
+import glob
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# history settings, changed with configure()
+config = {
+    'path' : 'flaskr/history.db',
+    'text_folder' : 'flaskr/generated_poems', # imported on creation
+}
+
+# process-wide history store, opened at most once
+_history = None
+_history_lock = threading.Lock()
+
+
+class PoemHistory():
+    """
+    PoemHistory stores generated poems in an SQLite table whose row ids grow
+    with every poem, so the newest poems come first in id order and pages are
+    read with an index seek from a cursor (the id of the last poem on the
+    previous page) however long the history grows. Each call opens its own
+    connection, so the store can be used from any thread or worker process.
+    """
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS poems (" \
+                               "id INTEGER PRIMARY KEY AUTOINCREMENT, " \
+                               "name TEXT NOT NULL, poem TEXT NOT NULL, " \
+                               "created REAL NOT NULL)")
+            # finds imported poems, whose name and date come from their file
+            connection.execute("CREATE INDEX IF NOT EXISTS " \
+                               "poems_name_created ON poems (name, created)")
+
+
+    @contextmanager
+    def connect(self):
+        """
+        Opens a connection to the database that commits on success and is
+        closed afterwards
+        """
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+    def add(self, name, poem, created=None):
+        """
+        Stores a poem and returns its id
+        """
+        with self.connect() as connection:
+            cursor = connection.execute("INSERT INTO poems " \
+                            "(name, poem, created) VALUES (?, ?, ?)", \
+                            (name, poem, created or time.time()))
+            return cursor.lastrowid
+
+
+    def count(self):
+        """
+        Returns the number of stored poems and the id of the newest one
+        """
+        with self.connect() as connection:
+            return connection.execute("SELECT COUNT(*), " \
+                            "COALESCE(MAX(id), 0) FROM poems").fetchone()
+
+
+    def page(self, before=None, limit=20):
+        """
+        Returns up to limit poems, newest first, that are older than the poem
+        with id before (or the newest poems if before is None), along with
+        the cursor of the next page, or None if this is the last page.
+        """
+        if before is None:
+            query = "SELECT id, name, poem, created FROM poems " \
+                    "ORDER BY id DESC LIMIT ?"
+            params = (limit + 1,)
+        else:
+            query = "SELECT id, name, poem, created FROM poems " \
+                    "WHERE id < ? ORDER BY id DESC LIMIT ?"
+            params = (before, limit + 1)
+        with self.connect() as connection:
+            rows = connection.execute(query, params).fetchall()
+
+        poems = [{'id' : poem_id, 'name' : name, 'poem' : poem, \
+                  'created' : created} for poem_id, name, poem, created in \
+                 rows[:limit]]
+        next_cursor = poems[-1]['id'] if len(rows) > limit else None
+        return poems, next_cursor
+
+
+    def import_text_files(self, folder):
+        """
+        Imports the poems stored as .txt files in a folder, oldest first, with
+        the file name as the poem name and its modification time as the date
+        of the poem. Poems already stored with the same name and date are
+        skipped, so importing a folder again only adds new files. Returns the
+        number of poems imported.
+        """
+        filenames = sorted(glob.glob(f"{folder}/*.txt"), key=os.path.getmtime)
+        num_imported = 0
+        with self.connect() as connection:
+            for filename in filenames:
+                with open(filename) as poem_file:
+                    poem = poem_file.read()
+                name = os.path.basename(filename)[:-4]
+                created = os.path.getmtime(filename)
+                cursor = connection.execute("INSERT INTO poems " \
+                            "(name, poem, created) SELECT ?, ?, ? " \
+                            "WHERE NOT EXISTS (SELECT 1 FROM poems " \
+                            "WHERE name = ? AND created = ?)", \
+                            (name, poem, created, name, created))
+                num_imported += cursor.rowcount
+        return num_imported
+
+
+def configure(**settings):
+    """
+    Updates the history settings
+    """
+    config.update(settings)
+
+
+def get_history():
+    """
+    Returns the process-wide history store, creating the database on first
+    use and importing the poems of the text folder into it.
+    """
+    global _history
+    if _history is None:
+        with _history_lock:
+            if _history is None:
+                is_new = not os.path.exists(config['path'])
+                _history = PoemHistory(config['path'])
+                if is_new and os.path.exists(config['text_folder']):
+                    num_poems = _history.import_text_files\
+                                                (config['text_folder'])
+                    logger.info("Imported %d poems from %s", num_poems, \
+                                config['text_folder'])
+    return _history
+
+
+if __name__ == "__main__":
+    num_poems = PoemHistory(config['path']).import_text_files\
+                                                (config['text_folder'])
+    logger.info("Imported %d poems from %s", num_poems, config['text_folder'])
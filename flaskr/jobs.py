@@ -0,0 +1,167 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class Job():
+    """
+    Job class represents one piece of work submitted to a JobQueue: the
+    function to run with its arguments, its status ('queued', 'running', 'done'
+    or 'failed'), its result or error, and how long each stage took. Jobs
+    submitted with events=True also keep a queue of the (event, data) pairs
+    published by the job function, ended by None once the job has finished,
+    for one subscriber to follow the job's progress.
+    """
+    def __init__(self, func, args, events=False):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.stage_seconds = dict() # filled in by the job function
+        self.events = queue.Queue() if events else None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+
+    def publish(self, event, data):
+        """
+        Publishes an (event, data) pair to the subscriber of the job, if it
+        was submitted with events=True
+        """
+        if self.events is not None:
+            self.events.put((event, data))
+
+
+    def subscribe(self, timeout=None):
+        """
+        Yields the (event, data) pairs published by the job as they come,
+        until it has finished. If no event comes within timeout seconds, None
+        is yielded instead, e.g. to keep a connection alive.
+        """
+        while True:
+            try:
+                item = self.events.get(timeout=timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if item is None:
+                return
+            yield item
+
+
+    def to_dict(self):
+        """
+        Returns the JSON-serializable state of the job
+        """
+        job_dict = {
+            'id' : self.id,
+            'status' : self.status,
+            'stage_seconds' : dict(self.stage_seconds),
+            'queued_seconds' : (self.started or time.time()) - self.created,
+        }
+        if self.finished is not None:
+            job_dict['run_seconds'] = self.finished - self.started
+        if self.status == 'done':
+            job_dict['result'] = self.result
+        elif self.status == 'failed':
+            job_dict['error'] = self.error
+        return job_dict
+
+
+class JobQueue():
+    """
+    JobQueue runs submitted jobs in a fixed number of worker threads. At most
+    max_queued jobs wait for a worker at once, so a burst of requests is turned
+    away instead of piling up, and the most recent max_finished finished jobs
+    are kept for their results to be collected. The worker threads are
+    started with the first job, so that creating a queue starts no thread.
+    """
+    def __init__(self, num_workers, max_queued, max_finished=1000):
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.max_finished = max_finished
+        self.lock = threading.Lock()
+        self.jobs = dict() # job id to queued or running job
+        self.finished_jobs = OrderedDict() # job id to job, oldest first
+        self.num_running = 0
+        self.num_workers = num_workers
+        self.started = False
+
+
+    def submit(self, func, *args, events=False):
+        """
+        Queues a call of func(job, *args) and returns the job, which keeps the
+        events the function publishes if events is True. Raises queue.Full if
+        max_queued jobs are already waiting.
+        """
+        job = Job(func, args, events)
+        with self.lock:
+            self.queue.put_nowait(job)
+            self.jobs[job.id] = job
+            if not self.started:
+                for i in range(self.num_workers):
+                    threading.Thread(target=self.work, daemon=True).start()
+                self.started = True
+        return job
+
+
+    def get(self, job_id):
+        """
+        Returns the job with the given id, or None if it is unknown or expired
+        """
+        with self.lock:
+            return self.jobs.get(job_id) or self.finished_jobs.get(job_id)
+
+
+    def depth(self):
+        """
+        Returns the number of jobs waiting for a worker
+        """
+        return self.queue.qsize()
+
+
+    def stats(self):
+        """
+        Returns the number of waiting and running jobs
+        """
+        with self.lock:
+            return {'queued' : self.queue.qsize(), 'running' : self.num_running}
+
+
+    def work(self):
+        """
+        Runs queued jobs one at a time, forever
+        """
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                job.status = 'running'
+                job.started = time.time()
+                self.num_running += 1
+
+            try:
+                result = job.func(job, *job.args)
+            except Exception as e:
+                logger.exception("Job %s failed", job.id)
+                result = None
+                job.error = f"{type(e).__name__}: {e}"
+
+            with self.lock:
+                job.result = result
+                job.status = 'failed' if job.error is not None else 'done'
+                job.finished = time.time()
+                self.num_running -= 1
+                del self.jobs[job.id]
+                self.finished_jobs[job.id] = job
+                while len(self.finished_jobs) > self.max_finished:
+                    self.finished_jobs.popitem(last=False)
+            if job.events is not None:
+                job.events.put(None)
+            self.queue.task_done()
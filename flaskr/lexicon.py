@@ -0,0 +1,196 @@
+"""
+Word-level lexicon of POS tags and sentiment scores for the corpus vocabulary,
+so that generation looks words up instead of running spaCy or TextBlob on
+them one at a time.
+
+Build the lexicon once, after building the corpus index, with:
+
+    python -m flaskr.lexicon
+"""
+import os
+import time
+import logging
+import threading
+import numpy as np
+from collections import Counter
+from textblob import TextBlob
+from . import corpus
+from . import corpus_index
+from . import nlp_pipeline
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+LEXICON_PATH = 'flaskr/lexicon.npz'
+
+# process-wide lexicon, loaded at most once
+_lexicon = None
+_lexicon_lock = threading.Lock()
+
+
+class Lexicon():
+    """
+    Lexicon class maps every word of the vocabulary to an int id, and stores
+    the most frequent POS tag, polarity and subjectivity of each word in
+    arrays indexed by that id. Words outside the vocabulary are tagged and
+    scored live the first time they are seen and remembered afterwards.
+    """
+    def __init__(self, words, tag_names, tag_ids, polarities, subjectivities, \
+                 corpus_stamp=None):
+        self.words = words # word by id
+        self.word_ids = {word : i for i, word in enumerate(words)}
+        self.tag_names = tag_names # tag label by tag id
+        self.tag_ids = tag_ids # most frequent tag id by word id
+        self.polarities = polarities # polarity by word id
+        self.subjectivities = subjectivities # subjectivity by word id
+        self.live_tags = dict() # word outside the vocabulary to tag
+        self.live_sentiments = dict() # word outside the vocabulary to scores
+        # corpus.corpus_stamp() of the corpus the lexicon was built from
+        self.corpus_stamp = corpus_stamp
+
+
+    def __len__(self):
+        return len(self.words)
+
+
+    def tag(self, word):
+        """
+        Returns the most frequent POS tag of a word
+        """
+        word = word.lower()
+        word_id = self.word_ids.get(word)
+        if word_id is not None:
+            return self.tag_names[self.tag_ids[word_id]]
+
+        if word not in self.live_tags.keys():
+            tag = ""
+            metrics.NLP_TEXTS.inc(kind='word')
+            for token in nlp_pipeline.get_nlp()(word):
+                tag = token.tag_
+            self.live_tags[word] = tag
+        return self.live_tags[word]
+
+
+    def sentiment(self, word):
+        """
+        Returns the (polarity, subjectivity) of a word
+        """
+        word = word.lower()
+        word_id = self.word_ids.get(word)
+        if word_id is not None:
+            return float(self.polarities[word_id]), \
+                   float(self.subjectivities[word_id])
+
+        if word not in self.live_sentiments.keys():
+            word_blob = TextBlob(word)
+            self.live_sentiments[word] = (word_blob.polarity, \
+                                          word_blob.subjectivity)
+        return self.live_sentiments[word]
+
+
+    def save(self, path=None):
+        """
+        Writes the lexicon arrays to a .npz file
+        """
+        np.savez(path or LEXICON_PATH, words=np.array(self.words), \
+                 tag_names=np.array(self.tag_names), tag_ids=self.tag_ids, \
+                 polarities=self.polarities, \
+                 subjectivities=self.subjectivities, \
+                 corpus_stamp=np.array(self.corpus_stamp, dtype=np.int64))
+
+
+def load_lexicon(path=None):
+    """
+    Reads a lexicon written by Lexicon.save
+    """
+    with np.load(path or LEXICON_PATH) as data:
+        corpus_stamp = None
+        if 'corpus_stamp' in data.files:
+            corpus_stamp = data['corpus_stamp'].tolist()
+        return Lexicon(data['words'].tolist(), data['tag_names'].tolist(), \
+                       data['tag_ids'], data['polarities'], \
+                       data['subjectivities'], corpus_stamp)
+
+
+def build_lexicon(docs):
+    """
+    Builds a lexicon over every token of the given parsed docs, which come
+    from the current corpus
+    """
+    tag_counts = Counter()
+    for doc in docs:
+        for token in doc:
+            tag_counts[(token.text.lower(), token.tag_)] += 1
+
+    # keep the most frequent tag of each word
+    word_tag = dict()
+    word_count = dict()
+    for (word, tag), count in tag_counts.items():
+        if count > word_count.get(word, 0):
+            word_tag[word] = tag
+            word_count[word] = count
+
+    words = sorted(word_tag.keys())
+    tag_names = sorted(set(word_tag.values()))
+    tag_name_ids = {tag : i for i, tag in enumerate(tag_names)}
+
+    tag_ids = np.zeros(len(words), dtype=np.int16)
+    polarities = np.zeros(len(words), dtype=np.float64)
+    subjectivities = np.zeros(len(words), dtype=np.float64)
+    for i, word in enumerate(words):
+        tag_ids[i] = tag_name_ids[word_tag[word]]
+        word_blob = TextBlob(word)
+        polarities[i] = word_blob.polarity
+        subjectivities[i] = word_blob.subjectivity
+
+    return Lexicon(words, tag_names, tag_ids, polarities, subjectivities, \
+                   corpus.corpus_stamp())
+
+
+def get_lexicon():
+    """
+    Returns the process-wide lexicon, or an empty one that computes every
+    word live if the lexicon has not been built or was built from an older
+    corpus.
+    """
+    global _lexicon
+    if _lexicon is None:
+        with _lexicon_lock:
+            if _lexicon is None:
+                loaded = None
+                if os.path.exists(LEXICON_PATH):
+                    loaded = load_lexicon()
+                    if loaded.corpus_stamp != corpus.corpus_stamp():
+                        logger.warning("Ignoring lexicon built from an " \
+                                       "older corpus; rebuild it with " \
+                                       "python -m flaskr.lexicon")
+                        loaded = None
+                if loaded is None:
+                    loaded = Lexicon([], [], np.zeros(0, dtype=np.int16), \
+                                     np.zeros(0, dtype=np.float64), \
+                                     np.zeros(0, dtype=np.float64))
+                _lexicon = loaded
+    return _lexicon
+
+
+def corpus_docs():
+    """
+    Yields every sentence doc of the corpus index
+    """
+    nlp = nlp_pipeline.get_nlp()
+    index = corpus_index.get_index(nlp)
+    if index is None:
+        raise FileNotFoundError("Build the corpus index first: " \
+                                "python -m flaskr.corpus_index")
+    for row_id in range(len(corpus.get_corpus())):
+        sentence_docs = index.get_docs(row_id, nlp.vocab)
+        if sentence_docs is not None:
+            yield from sentence_docs
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    lexicon = build_lexicon(corpus_docs())
+    lexicon.save()
+    logger.info("Built lexicon of %d words in %.0fs", len(lexicon), \
+                time.perf_counter() - start)
@@ -1,81 +1,132 @@
-import pandas as pd
+import time
 import random
+import logging
+from . import corpus
+from . import metrics
 from . import poem_generator as pg
 from . import object_detection as od
 
-def parse_poem_csv():
+logger = logging.getLogger(__name__)
+
+def parse_poem_csv(workspace, num_poems=10, rng=random):
     """
-    Reads in the dataset of inspiring poems and chooses 10 random poems to read
-    into files and populate the inspiring poems folder.
+    Chooses 10 random poems from the dataset of inspiring poems and stores
+    their row ids in the workspace. Returns the row ids of the chosen poems.
     """
-    df = pd.read_csv("flaskr/PoetryFoundationData.csv")
-
-    # choose 10 random indexes
-    indexes = []
-    for i in range(10):
-        rand_idx = random.randint(0, 13855)
-        if rand_idx not in indexes:
-            indexes.append(rand_idx)
-
-    # extract title and poem at each index
-    for idx in indexes:
-        title = df['Title'][idx]
-        title = title.strip()
-        if '/' in title: # skip because '/' is not allowed in file names
-            continue
-
-        # read poem to file with title as file name
-        filename = "-".join(title.split())
-        file_path = f'flaskr/inspiring_poems/{filename}.txt'
-        new_file = open(file_path, 'w')
-        poem = df['Poem'][idx]
-        new_file.write(poem)
-        new_file.close()
-
-
-def main():
+    poem_corpus = corpus.get_corpus()
+    metrics.CORPUS_POEMS.set(len(poem_corpus))
+
+    # choose 10 distinct random indexes
+    indexes = rng.sample(range(len(poem_corpus)), \
+                         min(num_poems, len(poem_corpus)))
+
+    # remember the rows so generation can use their pre-parsed sentences
+    workspace.save_rows(indexes)
+
+    return indexes
+
+
+def generate_events(workspace, num_candidates=1, budget_seconds=None, \
+                    stage_seconds=None, seed=None):
     """
-    Executes the main steps of poetry generation using a PoemGenerator object.
+    Executes the main steps of poetry generation using a PoemGenerator object
+    on the images and inspiring poems of the given workspace, yielding an
+    (event, data) pair as each stage completes: 'images', 'themes', 'corpus',
+    'sentence' for every line of the poem, 'revision' after each revision
+    step and finally 'poem'. With a single candidate, lines are
+    yielded while the poem is being written; with several, the candidates are
+    generated in parallel, within the wall-clock budget if one is given, and
+    the lines of the best one are yielded once it is chosen. The seconds spent
+    in each stage are recorded in the metrics, and in stage_seconds if a dict
+    is given. The same seed, workspace and candidates always give the same
+    poem, as long as no candidate is cut off by the budget; the seed used is
+    sent with the poem.
     """
     num_sentences = 5
+    if stage_seconds is None:
+        stage_seconds = dict()
+
+    # objects are detected in each image in the background once uploaded
+    start = time.perf_counter()
+    if not workspace.wait_for_detections():
+        logger.warning("Gave up waiting for the detections of %s", \
+                       workspace.folder)
+    image_results = workspace.read_image_results()
+    yield 'images', {'count' : len(image_results)}
+
+    # if no images were uploaded
+    if len(image_results) == 0:
+        yield 'poem', {'name' : "temp", 'poem' : "*NO IMAGES*", \
+                       'stage_seconds' : stage_seconds}
+        return
 
     # get themes from object detection
-    themes = od.detect_objects_in_images()
-
-    # if no images in folder or no objects were detected
-    if themes == None:
-        return ("temp", "*NO IMAGES*")
+    themes = od.themes_from_results(image_results)
+    stage_seconds['detection'] = time.perf_counter() - start
+    metrics.STAGE_SECONDS.observe(stage_seconds['detection'], \
+                                  stage='detection')
+    yield 'themes', {'themes' : themes}
 
-    generator = pg.PoemGenerator()
+    start = time.perf_counter()
+    generator = pg.PoemGenerator(seed)
+    seed = generator.rng.seed_value
 
     # initialization steps
 
-    generator.read_poem_files_to_strings()
+    row_ids = workspace.read_rows()
+    if row_ids is None:
+        row_ids = parse_poem_csv(workspace, rng=generator.rng)
+    generator.read_poem_rows(row_ids)
     generator.parse_inspiring_poems()
     generator.parse_themes(themes)
-
-    # generation step
-
-    poem = generator.generate_poem(num_sentences, themes)
-
-    # evaluation/revision steps
-
-    themed_poem = generator.improve_poem_themes(poem)
-    avg_pol, avg_sub = generator.evaluate_sentiment(themed_poem)
-
-    goal_pol = (avg_pol + 0.01) * 1.05
-    goal_sub = (avg_sub + 0.01) * 1.05
-
-    updated_poem = generator.improve_poem_sentiment\
-                            (themed_poem, goal_pol, goal_sub)
+    stage_seconds['parsing'] = time.perf_counter() - start
+    metrics.STAGE_SECONDS.observe(stage_seconds['parsing'], stage='parsing')
+    yield 'corpus', {'poems' : generator.ingestion_stats['poems'], \
+                     'tokens' : generator.ingestion_stats['tokens']}
+
+    # generation, evaluation/revision and selection steps
+
+    start = time.perf_counter()
+    if num_candidates > 1:
+        updated_poem = generator.generate_candidates(num_candidates, \
+                                num_sentences, themes, budget_seconds)
+        for idx, sentence in enumerate(updated_poem.sentence_list):
+            yield 'sentence', {'index' : idx, 'text' : sentence.text}
+    else:
+        sentence_list = []
+        for sentence in generator.generate_sentences(num_sentences, themes):
+            yield 'sentence', {'index' : len(sentence_list), \
+                               'text' : sentence.text}
+            sentence_list.append(sentence)
+        updated_poem = generator.new_poem(sentence_list, themes)
+        for step, updated_poem in generator.revise_poem(updated_poem):
+            yield 'revision', {'step' : step, \
+                        'lines' : updated_poem.return_sentence_list_text()}
+    stage_seconds['generation'] = time.perf_counter() - start
+    metrics.STAGE_SECONDS.observe(stage_seconds['generation'], \
+                                  stage='generation')
+    metrics.REVISION_ITERATIONS.observe(updated_poem.revision_iterations)
 
     # reformat step
 
+    start = time.perf_counter()
     final_poem = generator.reformat_poem(updated_poem)
+    stage_seconds['reformat'] = time.perf_counter() - start
+    metrics.STAGE_SECONDS.observe(stage_seconds['reformat'], stage='reformat')
 
     # final artifact
-    
-    final_text = final_poem.text
-    final_name = final_poem.name
 
-    return (final_name, final_text)
\ No newline at end of file
+    yield 'poem', {'name' : final_poem.name, 'poem' : final_poem.text, \
+                   'seed' : seed, 'stage_seconds' : stage_seconds}
+
+
+def main(workspace, num_candidates=1, budget_seconds=None, \
+         stage_seconds=None, seed=None):
+    """
+    Executes all steps of poetry generation and returns the name and text of
+    the final poem. See generate_events for the arguments.
+    """
+    for event, data in generate_events(workspace, num_candidates, \
+                                       budget_seconds, stage_seconds, seed):
+        if event == 'poem':
+            return (data['name'], data['poem'])
@@ -0,0 +1,248 @@
+"""
+Process-wide counters, gauges and histograms of where generation time goes,
+exposed in the Prometheus text format at /metrics, and opt-in cProfile dumps
+of single requests.
+
+Metrics are kept in the memory of the process that records them, so work
+done in forked candidate workers is only counted through what the parent
+records about it.
+"""
+import os
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets of durations, in seconds
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, \
+                   30, 60)
+
+# metrics settings, changed with configure()
+config = {
+    'profile_folder' : 'flaskr/profiles', # cProfile dumps of requests
+}
+
+# every metric created, in order, for render()
+_registry = []
+
+
+class Metric():
+    """
+    Metric class is the base of every metric: a name, a help text and the
+    names of its labels, with one value per combination of label values.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = dict() # tuple of label values to value
+        _registry.append(self)
+
+
+    def key(self, labels):
+        """
+        Returns the tuple of label values for the given labels
+        """
+        return tuple(str(labels[name]) for name in self.label_names)
+
+
+    def label_text(self, key, extra=()):
+        """
+        Returns the {name="value",...} part of a sample line
+        """
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if len(pairs) == 0:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in \
+                              pairs) + "}"
+
+
+    def samples(self):
+        """
+        Returns the sample lines of the metric
+        """
+        with self.lock:
+            return [f"{self.name}{self.label_text(key)} {value}" for \
+                    key, value in sorted(self.values.items())]
+
+
+    def render(self):
+        """
+        Returns the metric in the Prometheus text format
+        """
+        return [f"# HELP {self.name} {self.help_text}", \
+                f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+
+class Counter(Metric):
+    """
+    Counter class is a metric that only goes up
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauge class is a metric set to its latest value
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Histogram class counts observed values into cumulative buckets, and keeps
+    their sum and count, so that rates and quantiles can be computed from it.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), \
+                 buckets=SECONDS_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values.keys():
+                # count per bucket, then sum and count of all values
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            bucket_counts, _, _ = self.values[key]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[idx] += 1
+            self.values[key][1] += value
+            self.values[key][2] += 1
+
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the seconds spent in the with block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+    def samples(self):
+        lines = []
+        with self.lock:
+            for key, (bucket_counts, total, count) in \
+                    sorted(self.values.items()):
+                labels = self.label_text(key)
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f"{self.name}_bucket" \
+                        f"{self.label_text(key, [('le', bound)])} " \
+                        f"{bucket_count}")
+                lines.append(f"{self.name}_bucket" \
+                        f"{self.label_text(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text format
+    """
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def configure(**settings):
+    """
+    Updates the metrics settings
+    """
+    config.update(settings)
+
+
+@contextmanager
+def profiled(name):
+    """
+    Profiles the calling thread with cProfile while the with block runs and
+    dumps the stats to a .prof file in the profile folder, to be read with
+    pstats or snakeviz. The block runs unprofiled if another profiler is
+    already active.
+    """
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        logger.warning("Not profiling %s: another profiler is active", name)
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        folder = config['profile_folder']
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, f"{time.strftime('%Y%m%d-%H%M%S')}-" \
+                                    f"{name}-{threading.get_ident()}.prof")
+        profiler.dump_stats(path)
+        logger.info("Profiled %s (%.2fs) into %s", name, \
+                    pstats.Stats(profiler).total_tt, path)
+
+
+# durations of the stages of each request and of the work inside them
+REQUEST_SECONDS = Histogram('flaskr_request_seconds', \
+                    "Seconds spent handling each request", ['endpoint'])
+STAGE_SECONDS = Histogram('flaskr_stage_seconds', \
+                    "Seconds spent in each stage of poem generation", \
+                    ['stage'])
+DETECTION_SECONDS = Histogram('flaskr_detection_seconds', \
+                    "Seconds spent running the detector on a set of images")
+
+# amount of work done
+NLP_TEXTS = Counter('flaskr_nlp_texts_total', \
+                    "Texts run through the spaCy pipeline, by whether they " \
+                    "were parsed in batches or tagged one word at a time", \
+                    ['kind'])
+SENTIMENT_SCORINGS = Counter('flaskr_sentiment_scorings_total', \
+                    "Sentences scored with TextBlob")
+DETECTED_IMAGES = Counter('flaskr_detected_images_total', \
+                    "Images run through the detector")
+DETECTION_CACHE = Counter('flaskr_detection_cache_total', \
+                    "Detection cache lookups by result", ['result'])
+CORPUS_POEMS = Gauge('flaskr_corpus_poems', \
+                    "Poems in the loaded corpus")
+INGESTED_TOKENS = Histogram('flaskr_ingested_tokens', \
+                    "Tokens of inspiring poems ingested per generator", \
+                    buckets=(500, 1000, 2500, 5000, 10000, 25000, 50000))
+REVISION_ITERATIONS = Histogram('flaskr_revision_iterations', \
+                    "Sentiment revision steps taken per poem", \
+                    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+GENERATION_CANDIDATES = Histogram('flaskr_generation_candidates', \
+                    "Candidate poems finished per request", \
+                    buckets=(1, 2, 4, 8, 16, 32))
+GENERATION_JOBS = Gauge('flaskr_generation_jobs', \
+                    "Generation jobs waiting for or running on a worker", \
+                    ['state'])
+DETECTION_JOBS = Gauge('flaskr_detection_jobs', \
+                    "Detection jobs waiting for or running on a worker", \
+                    ['state'])
+PREPROCESS_QUEUE_DEPTH = Gauge('flaskr_preprocess_queue_depth', \
+                    "Images waiting for a free preprocessing thread")
@@ -0,0 +1,38 @@
+import spacy
+import threading
+from . import metrics
+
+# spaCy model used to parse inspiring poems
+SPACY_MODEL = "en_core_web_sm"
+
+# pipeline components that are never used: generation only needs the tagger
+# for POS tags and the parser for dependencies and sentence boundaries
+EXCLUDED_COMPONENTS = ["ner", "lemmatizer", "attribute_ruler"]
+
+# process-wide pipeline shared by every generator, loaded at most once
+_nlp = None
+_nlp_lock = threading.Lock()
+
+
+def get_nlp():
+    """
+    Returns the process-wide spaCy pipeline, loading it on first use.
+    """
+    global _nlp
+    if _nlp is None:
+        with _nlp_lock:
+            # another thread may have loaded it while we waited for the lock
+            if _nlp is None:
+                _nlp = spacy.load(SPACY_MODEL, exclude=EXCLUDED_COMPONENTS)
+    return _nlp
+
+
+def parse_many(texts, n_process=1, batch_size=64):
+    """
+    Parses many texts at once with nlp.pipe and returns the list of docs.
+    Using more than one process is worth it for large offline jobs such as
+    building the corpus index, not for a single request.
+    """
+    nlp = get_nlp()
+    metrics.NLP_TEXTS.inc(len(texts), kind='batch')
+    return list(nlp.pipe(texts, n_process=n_process, batch_size=batch_size))
@@ -1,126 +1,520 @@
+import io
+import os
 import torch
-from PIL import Image
-from torchvision.models.detection import fasterrcnn_resnet50_fpn 
+import numpy as np
+import time
+import logging
+import threading
+from functools import lru_cache
+from PIL import Image, ImageOps
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from torchvision.models.detection import fasterrcnn_resnet50_fpn
 from torchvision.models.detection import FasterRCNN_ResNet50_FPN_Weights
+from torchvision.models.detection import fasterrcnn_mobilenet_v3_large_fpn
+from torchvision.models.detection import \
+                                    FasterRCNN_MobileNet_V3_Large_FPN_Weights
 import glob
-from textblob import TextBlob
+from textblob import Word
+from .detection_cache import DetectionCache, image_key
+from . import metrics
 
-def detect_objects_in_images():
+logger = logging.getLogger(__name__)
+
+device = 'cpu'
+
+# detection settings, overridable with configure()
+config = {
+    'backend' : 'eager', # detector model to use, one of BACKENDS
+    'max_image_side' : 1333, # longest image side fed to the model
+    'batch_size' : 4, # number of images run through the model at once
+    'score_threshold' : 0.5, # minimum score for a detected object
+    'cache_folder' : 'flaskr/detection_cache', # stored detection results
+    'cache_max_bytes' : 64 * 1024 * 1024, # size of the results cache
+    'preprocess_workers' : min(4, os.cpu_count() or 1), # decoding threads
+    'max_image_pixels' : 25000000, # larger uploads are rejected undecoded
+}
+
+# leading bytes of each accepted image format
+IMAGE_SIGNATURES = {
+    'jpeg' : b'\xff\xd8\xff',
+    'png' : b'\x89PNG\r\n\x1a\n',
+}
+
+# detectors shared by every request, one per backend, each loaded at most once
+_detectors = dict()
+_detector_lock = threading.Lock()
+
+# process-wide cache of detection results, created on first use
+_cache = None
+_cache_lock = threading.Lock()
+
+# thread pool that decodes and preprocesses images, created on first use
+_preprocess_pool = None
+_preprocess_lock = threading.Lock()
+_preprocess_queued = 0 # images waiting for a free preprocessing thread
+
+
+class Detector():
+    """
+    Detector class holds a loaded detection model in eval mode together with
+    the preprocessing transforms and object classes of its weights. A single
+    instance is shared by all requests in the process; the model is only read
+    from during inference, so concurrent requests can use it at the same time.
+    """
+    def __init__(self, backend, model, weights, load_seconds, scripted=False):
+        self.backend = backend # name of the backend that built the model
+        self.model = model
+        self.transforms = weights.transforms()
+        self.categories = weights.meta['categories'] # class names by label
+        self.load_seconds = load_seconds # time taken to build the model
+        self.scripted = scripted # whether the model is a TorchScript module
+
+
+    def __call__(self, input_list):
+        """
+        Runs the model on a list of image tensors and returns a list of
+        dictionaries of boxes, labels and scores, one per image.
+        """
+        with torch.inference_mode():
+            outputs = self.model(input_list)
+        # scripted detection models return a (losses, detections) tuple
+        if self.scripted:
+            outputs = outputs[1]
+        return outputs
+
+
+def load_eager():
+    """
+    Builds the float32 Faster-RCNN ResNet50-FPN model.
+    """
+    weights = FasterRCNN_ResNet50_FPN_Weights.DEFAULT
+    model = fasterrcnn_resnet50_fpn(weights=weights)
+    return model.to(device).eval(), weights
+
+
+def load_quantized():
+    """
+    Builds the Faster-RCNN ResNet50-FPN model with its fully connected layers
+    dynamically quantized to int8.
+    """
+    model, weights = load_eager()
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, \
+                                                   dtype=torch.qint8)
+    return model, weights
+
+
+def load_torchscript():
+    """
+    Builds the Faster-RCNN ResNet50-FPN model compiled to a frozen TorchScript
+    module.
+    """
+    model, weights = load_eager()
+    model = torch.jit.freeze(torch.jit.script(model))
+    return model, weights
+
+
+def load_mobilenet():
+    """
+    Builds the lighter Faster-RCNN MobileNetV3-Large-FPN model.
+    """
+    weights = FasterRCNN_MobileNet_V3_Large_FPN_Weights.DEFAULT
+    model = fasterrcnn_mobilenet_v3_large_fpn(weights=weights)
+    return model.to(device).eval(), weights
+
+
+# detector backend name to the function that builds its model
+BACKENDS = {
+    'eager' : load_eager,
+    'quantized' : load_quantized,
+    'torchscript' : load_torchscript,
+    'mobilenet' : load_mobilenet,
+}
+
+# detector backend name to the pre-trained weights it uses
+BACKEND_WEIGHTS = {
+    'eager' : FasterRCNN_ResNet50_FPN_Weights.DEFAULT,
+    'quantized' : FasterRCNN_ResNet50_FPN_Weights.DEFAULT,
+    'torchscript' : FasterRCNN_ResNet50_FPN_Weights.DEFAULT,
+    'mobilenet' : FasterRCNN_MobileNet_V3_Large_FPN_Weights.DEFAULT,
+}
+
+
+def load_detector(backend):
+    """
+    Builds a new detector with the given backend.
+    """
+    if backend not in BACKENDS.keys():
+        raise KeyError(f"Unknown detector backend: {backend}")
+
+    start = time.perf_counter()
+    model, weights = BACKENDS[backend]()
+    load_seconds = time.perf_counter() - start
+    logger.info("Loaded %s detector in %.2fs", backend, load_seconds)
+
+    return Detector(backend, model, weights, load_seconds, \
+                    scripted=(backend == 'torchscript'))
+
+
+def get_detector(backend=None):
+    """
+    Returns the process-wide detector of the given backend (the configured
+    one by default), loading it on first use.
+    """
+    if backend is None:
+        backend = config['backend']
+    if backend not in _detectors.keys():
+        with _detector_lock:
+            # another thread may have loaded it while we waited for the lock
+            if backend not in _detectors.keys():
+                _detectors[backend] = load_detector(backend)
+    return _detectors[backend]
+
+
+def warm_up_detector(backend=None):
+    """
+    Loads the detector and runs it on a blank image so that the first user
+    request does not pay for model loading or first-inference allocations.
+    Returns a dictionary of the load time and the cold and warm inference
+    latencies in seconds.
+    """
+    if backend is None:
+        backend = config['backend']
+    was_loaded = backend in _detectors.keys()
+    detector = get_detector(backend)
+    blank_img = torch.zeros((3, 480, 640))
+
+    latencies = []
+    for i in range(2):
+        start = time.perf_counter()
+        detector([blank_img])
+        latencies.append(time.perf_counter() - start)
+
+    timings = {
+        'load_seconds' : 0.0 if was_loaded else detector.load_seconds,
+        'cold_inference_seconds' : latencies[0],
+        'warm_inference_seconds' : latencies[1],
+    }
+    logger.info("Detector warm-up (%s): load %.2fs, cold inference %.2fs, " \
+                "warm inference %.2fs", backend, timings['load_seconds'], \
+                timings['cold_inference_seconds'], \
+                timings['warm_inference_seconds'])
+    return timings
+
+
+def configure(**settings):
+    """
+    Overrides detection settings, e.g. configure(batch_size=2).
+    """
+    global _cache, _preprocess_pool
+    for key, value in settings.items():
+        if key not in config.keys():
+            raise KeyError(f"Unknown detection setting: {key}")
+        config[key] = value
+    # the cache and pool are recreated with the new settings on next use
+    _cache = None
+    with _preprocess_lock:
+        if _preprocess_pool is not None:
+            _preprocess_pool.shutdown(wait=False)
+        _preprocess_pool = None
+
+
+def get_cache():
+    """
+    Returns the process-wide cache of detection results.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DetectionCache(config['cache_folder'], \
+                                    config['cache_max_bytes'])
+        return _cache
+
+
+def detection_version():
     """
-    Processes image files from the images folder and enters them as inputs
-    for a Faster-RCNN network for object detection. Processes the detected
-    labels and returns as a list of themes.
+    Returns a string identifying the model and every setting that affects its
+    results, so that cached results are not reused once any of them change.
     """
+    weights_name = BACKEND_WEIGHTS[config['backend']].name
+    return f"{config['backend']}/{weights_name}|{config['max_image_side']}|" \
+           f"{config['score_threshold']}"
 
-    device = 'cpu'
 
-    # load images into PIL files
+def check_image(image_bytes):
+    """
+    Returns the format of an uploaded image, judged by its leading bytes
+    rather than its file name, or None if it is not an accepted format or has
+    more pixels than the configured maximum. Only the image header is read, so
+    decompression bombs are turned away before they are decoded.
+    """
+    image_format = None
+    for name, signature in IMAGE_SIGNATURES.items():
+        if image_bytes.startswith(signature):
+            image_format = name
+    if image_format is None:
+        return None
 
-    PIL_images = []
-    for filename in glob.glob("flaskr/images/*"): 
-        img = Image.open(filename)
-        PIL_images.append(img)
-    
-    # if no files in the images folder
-    if len(PIL_images) == 0:
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            width, height = img.size
+    except (OSError, Image.DecompressionBombError):
         return None
-        
-    # load Faster RCNN model
+    if width * height > config['max_image_pixels']:
+        return None
+    return image_format
 
-    weights_rcnn = FasterRCNN_ResNet50_FPN_Weights.DEFAULT
-    model_rcnn = fasterrcnn_resnet50_fpn(weights=weights_rcnn)
-    model_rcnn.to(device)
 
-    # preprocess images for Faster RCNN
+def load_image(image_file):
+    """
+    Opens an image file (a path or a file object), rotates it upright
+    according to its EXIF orientation, converts it to RGB and shrinks it so
+    that its longest side is at most the configured maximum. JPEGs are decoded
+    directly at a reduced scale, so full resolution photos are never held in
+    memory.
+    """
+    max_side = config['max_image_side']
+    img = Image.open(image_file)
+    img.draft('RGB', (max_side, max_side))
+    img = ImageOps.exif_transpose(img)
+    img = img.convert('RGB')
+    img.thumbnail((max_side, max_side))
+    return img
 
-    transforms_rcnn = weights_rcnn.transforms()
-    input_list_rcnn = []
-    for img in PIL_images:
-        transformed_img = transforms_rcnn(img)
-        input_list_rcnn.append(transformed_img)
-        
-    # run images through Faster RCNN model
 
-    model_rcnn.eval()
-    results_rcnn = model_rcnn(input_list_rcnn)
+def get_preprocess_pool():
+    """
+    Returns the process-wide thread pool that decodes and preprocesses images.
+    PIL releases the GIL while decoding and resizing, so images are prepared
+    in parallel while earlier ones are run through the detector.
+    """
+    global _preprocess_pool
+    with _preprocess_lock:
+        if _preprocess_pool is None:
+            _preprocess_pool = ThreadPoolExecutor( \
+                            max_workers=config['preprocess_workers'], \
+                            thread_name_prefix='preprocess')
+        return _preprocess_pool
 
-    score_threshold = 0.5
 
-    weights = FasterRCNN_ResNet50_FPN_Weights.DEFAULT
+def preprocess_queue_depth():
+    """
+    Returns the number of images waiting for a free preprocessing thread.
+    """
+    return _preprocess_queued
 
-    # get all the possible object classes from the model
-    classes_rcnn = weights.meta['categories']
 
-    label_tensors = []
-    score_tensors = []
+def preprocess_image(image_file, transforms):
+    """
+    Loads an image and applies the detector's transforms to it. Runs on the
+    preprocessing pool.
+    """
+    global _preprocess_queued
+    with _preprocess_lock:
+        _preprocess_queued -= 1
+    return transforms(load_image(image_file))
 
-    # extract labels and scores from the network's outputs
-    for i in range(len(results_rcnn)):
-        result = results_rcnn[i]
-        scores = result['scores']
-        labels_idx = result['labels'][scores > score_threshold]
-        label_tensors.append(labels_idx)
-        scores = result['scores'][scores > score_threshold]
-        score_tensors.append(scores)
 
-    all_labels = []
+def submit_preprocess(image_file, transforms):
+    """
+    Queues an image on the preprocessing pool and returns its future.
+    """
+    global _preprocess_queued
+    pool = get_preprocess_pool()
+    with _preprocess_lock:
+        _preprocess_queued += 1
+    return pool.submit(preprocess_image, image_file, transforms)
+
+
+def run_detector(image_files, backend=None):
+    """
+    Runs the detector over the given image files in micro-batches under
+    inference mode and returns a list of (labels, scores) lists, one pair
+    per image, or None for images that could not be decoded, e.g. truncated
+    files. Images are preprocessed on a thread pool at most two batches
+    ahead of the detector, which bounds the memory used by a request
+    regardless of how many images it has.
+    """
+    detector = get_detector(backend)
+    batch_size = config['batch_size']
+    score_threshold = config['score_threshold']
+
+    # start preprocessing the first two batches
+    futures = deque() # (image index, future) pairs
+    next_idx = 0
+    while next_idx < len(image_files) and next_idx < 2 * batch_size:
+        futures.append((next_idx, submit_preprocess(image_files[next_idx], \
+                                                    detector.transforms)))
+        next_idx += 1
 
-    # transform label tensors into numpy arrays
-    for labels_idx in label_tensors:
-        if torch.is_tensor(labels_idx):
-            labels_idx = labels_idx.detach().numpy()
-            for idx in labels_idx:
-                all_labels.append(classes_rcnn[idx])
+    results = [None] * len(image_files)
+    while len(futures) > 0:
+        # wait for the next batch of preprocessed images, queueing one new
+        # image for each image taken
+        input_idxs = []
+        input_list_rcnn = []
+        while len(futures) > 0 and len(input_list_rcnn) < batch_size:
+            image_idx, future = futures.popleft()
+            try:
+                input_list_rcnn.append(future.result())
+                input_idxs.append(image_idx)
+            except Exception as e:
+                # uploads are only checked up to their header
+                logger.warning("Skipping image that could not be decoded: " \
+                               "%s: %s", type(e).__name__, e)
+            if next_idx < len(image_files):
+                futures.append((next_idx, \
+                                submit_preprocess(image_files[next_idx], \
+                                                  detector.transforms)))
+                next_idx += 1
+        if len(input_list_rcnn) == 0:
+            continue
 
-    all_scores = []
+        # run images through Faster RCNN model
+        results_rcnn = detector(input_list_rcnn)
 
-    # transform score tensors into numpy arrays
-    for scores in score_tensors:
-        if torch.is_tensor(scores):
-            scores = scores.detach().numpy()
-            for score in scores:
-                all_scores.append(float(score))
+        # keep only labels and scores above the threshold
+        for image_idx, result in zip(input_idxs, results_rcnn):
+            scores = result['scores']
+            keep = scores > score_threshold
+            results[image_idx] = (result['labels'][keep].tolist(), \
+                                  scores[keep].tolist())
 
-    labels_set = set(all_labels.copy())
+        del input_list_rcnn, results_rcnn
 
-    label_to_score = dict()
+    return results
 
-    # parse all distinct labels
-    for label in labels_set:
 
-        # find highest corresponding score for a certain label
+def detect_image_results(images_bytes):
+    """
+    Returns the (labels, scores) lists detected in each of the given encoded
+    images, or None for images that could not be decoded. Images found in the
+    cache skip the detector, and repeated images within the same request are
+    only run once.
+    """
+    cache = get_cache()
+    version = detection_version()
+    keys = [image_key(image_bytes, version) for image_bytes in images_bytes]
+
+    key_to_result = dict()
+    missing_keys = []
+    missing_images = []
+    for key, image_bytes in zip(keys, images_bytes):
+        if key in key_to_result or key in missing_keys:
+            continue
+        result = cache.get(key)
+        if result is None:
+            missing_keys.append(key)
+            missing_images.append(io.BytesIO(image_bytes))
+        else:
+            key_to_result[key] = result
+    metrics.DETECTION_CACHE.inc(len(key_to_result), result='hit')
+    metrics.DETECTION_CACHE.inc(len(missing_keys), result='miss')
+
+    # run only the images that have not been seen before
+    if len(missing_images) > 0:
+        with metrics.DETECTION_SECONDS.time():
+            detected = run_detector(missing_images)
+        metrics.DETECTED_IMAGES.inc(len(missing_images))
+        for key, result in zip(missing_keys, detected):
+            if result is not None:
+                cache.put(key, *result)
+            key_to_result[key] = result
 
-        label_score = 0
-        # parse all instances of current label
-        for instance in all_labels:
-            if instance == label:
-                idx = all_labels.index(instance)
-                if all_scores[idx] > label_score:
-                    label_score = all_scores[idx]
+    return [key_to_result[key] for key in keys]
 
+
+@lru_cache(maxsize=None)
+def pluralize_label(label):
+    """
+    Returns the plural form of an object class name, e.g. "traffic lights".
+    Only the last word of multi-word names is pluralized. Results are cached,
+    so each of the model's object classes is only inflected once.
+    """
+    words = label.split()
+    if len(words) == 0:
+        return label
+    words[-1] = str(Word(words[-1]).pluralize())
+    return " ".join(words)
+
+
+def aggregate_themes(image_results, categories, max_num_themes=5):
+    """
+    Combines the labels detected in every image into a list of at most
+    max_num_themes themes, pluralizing labels that appear more than once and
+    keeping the highest scoring labels.
+    """
+    # flatten labels and scores over all images
+    all_labels = np.array([idx for labels_idx, _ in image_results \
+                           for idx in labels_idx], dtype=np.int64)
+    all_scores = np.array([score for _, scores in image_results \
+                           for score in scores], dtype=np.float64)
+
+    if len(all_labels) == 0:
+        return []
+
+    # count every distinct label and find its highest score in one pass
+    unique_labels, inverse, counts = np.unique(all_labels, \
+                                    return_inverse=True, return_counts=True)
+    label_scores = np.zeros(len(unique_labels))
+    np.maximum.at(label_scores, inverse, all_scores)
+
+    # pick the highest scoring labels as the themes
+    final_labels = []
+    for i in np.argsort(-label_scores, kind='stable'):
+        label = categories[unique_labels[i]]
         # pluralize the label if more than one instance
+        if counts[i] > 1:
+            label = pluralize_label(label)
+        if label not in final_labels:
+            final_labels.append(label)
+        if len(final_labels) == max_num_themes:
+            break
+
+    return final_labels
+
+
+def read_images(images_folder):
+    """
+    Returns the encoded bytes of every image file in a folder
+    """
+    images_bytes = []
+    for filename in sorted(glob.glob(f"{images_folder}/*")):
+        with open(filename, 'rb') as file:
+            images_bytes.append(file.read())
+    return images_bytes
+
+
+def themes_from_results(image_results):
+    """
+    Returns the list of themes for the (labels, scores) detected in images
+    """
+    # get all the possible object classes from the model
+    categories = BACKEND_WEIGHTS[config['backend']].meta['categories']
+
+    return aggregate_themes(image_results, categories)
+
+
+def detect_themes(images_bytes):
+    """
+    Runs object detection on the given encoded images and returns the
+    detected labels as a list of themes. Images that could not be decoded are
+    left out.
+    """
+    return themes_from_results([result for result in \
+                    detect_image_results(images_bytes) if result is not None])
+
+
+def detect_objects_in_images(images_folder):
+    """
+    Processes image files from a folder and enters them as inputs for a
+    Faster-RCNN network for object detection. Processes the detected labels
+    and returns as a list of themes.
+    """
+    images_bytes = read_images(images_folder)
+
+    # if no files in the folder
+    if len(images_bytes) == 0:
+        return None
 
-        if all_labels.count(label) > 1:
-            blob = TextBlob(label)
-            label_list = blob.words.pluralize()
-            pluralized_token = label_list[0]
-            pluralized_label = ""
-            for char in pluralized_token:
-                pluralized_label += char
-            label_to_score[pluralized_label] = label_score
-            
-        else: # if only one instance of label
-            label_to_score[str(label)] = label_score
-
-    final_labels = list(label_to_score.keys())
-    max_num_themes = 5
-
-    # if more themes than max number
-    if len(final_labels) > max_num_themes:
-        # sort labels by descending order of corresponding scores
-        sorted_dict = {k: v for k, v in sorted(label_to_score.items(), \
-                                    key=lambda item: item[1], reverse=True)}
-        # pick the highest scoring labels as the themes
-        final_labels = list(sorted_dict.keys())[:max_num_themes]
-    
-    return final_labels
\ No newline at end of file
+    return detect_themes(images_bytes)
@@ -1,21 +1,189 @@
-import spacy
-import glob
+import time
+import atexit
+import pickle
+import logging
+import secrets
+import threading
+import multiprocessing
 import contractions
-from random import choice
-from random import randint
+from collections import namedtuple
 from textblob import TextBlob
-from numpy.random import choice as npc
+from . import corpus
+from . import corpus_index
+from . import nlp_pipeline
+from . import lexicon
+from . import metrics
+from .vocabulary import IndexedSet, ScoreIndex
+from .rng import BlockRandom
+
+logger = logging.getLogger(__name__)
+
+# generation settings, changed with configure()
+config = {
+    'max_revisions' : 100, # revision steps to reach the sentiment goals
+    'max_candidates' : 8, # candidate poems generated per request
+    'max_budget_seconds' : 60, # wall-clock budget for generating them
+}
+
+# process-wide pool of candidate workers, started by start_candidate_pool
+_candidate_pool = None
+_candidate_pool_size = 0
+_candidate_pool_lock = threading.Lock()
+
+# generator state last sent to this candidate worker, as (state id, generator)
+_worker_generator = None
+
+
+def expand_contractions(sentence_str):
+    """
+    Removes contractions from a sentence and lowercases it
+    """
+    expanded_words = []
+    for word in sentence_str.split():
+        expanded_words.append(contractions.fix(word))
+    return " ".join(expanded_words).lower()
+
+
+def parse_poem_sentences(texts, n_process=1):
+    """
+    Separates each poem into sentences and returns, for each poem, a list of
+    parsed docs, one for each sentence with its contractions removed. All
+    poems, then all of their sentences, are parsed in batches.
+    """
+    poem_sentences = []
+    for doc in nlp_pipeline.parse_many(texts, n_process=n_process):
+        sentence_strs = []
+        # use nlp to separate poem to sentences
+        for sentence in doc.sents:
+            sentence_str = sentence.text.strip()
+            if sentence_str == "":
+                continue
+            sentence_strs.append(expand_contractions(sentence_str))
+        poem_sentences.append(sentence_strs)
+
+    all_sentence_docs = nlp_pipeline.parse_many([sentence_str for \
+                        sentence_strs in poem_sentences for sentence_str in \
+                        sentence_strs], n_process=n_process)
+
+    # split the parsed sentences back up by poem
+    sentence_docs = []
+    start = 0
+    for sentence_strs in poem_sentences:
+        sentence_docs.append(all_sentence_docs[start:start+len(sentence_strs)])
+        start += len(sentence_strs)
+    return sentence_docs
+
+
+def configure(**settings):
+    """
+    Updates the generation settings
+    """
+    config.update(settings)
+
+
+def start_candidate_pool(processes):
+    """
+    Starts the process-wide pool of workers that generate candidate poems.
+    Workers are forked, so this must be called before the process starts any
+    threads, whose locks the workers would otherwise inherit in whatever state
+    they were in; the spaCy pipeline and lexicon are loaded first so that the
+    workers share them. Does nothing if the pool is running or fork is not
+    available, in which case candidates are generated one after another.
+    """
+    global _candidate_pool, _candidate_pool_size
+    with _candidate_pool_lock:
+        if _candidate_pool is not None or processes < 2 or \
+                'fork' not in multiprocessing.get_all_start_methods():
+            return
+        nlp_pipeline.get_nlp()
+        lexicon.get_lexicon()
+        _candidate_pool = multiprocessing.get_context('fork').Pool(processes)
+        _candidate_pool_size = processes
+        atexit.register(_candidate_pool.terminate)
+
+
+def generate_candidate(task):
+    """
+    Generates one revised candidate poem in a pool worker from the pickled
+    state of the request's generator, which is unpickled once per worker and
+    request. Returns a None poem without generating anything if the deadline
+    has already passed.
+    """
+    global _worker_generator
+    candidate_idx, seed, num_sents, themes, state_id, state, deadline = task
+    if time.time() >= deadline:
+        return candidate_idx, None
+    if _worker_generator is None or _worker_generator[0] != state_id:
+        _worker_generator = (state_id, pickle.loads(state))
+    generator = _worker_generator[1]
+    return candidate_idx, generator.generate_seeded_poem(seed, num_sents, \
+                                                         themes)
+
+
+class SentenceTemplate(namedtuple('SentenceTemplate', \
+                ['text', 'words', 'tags', 'deps', 'heads', 'children', 'root'])):
+    """
+    SentenceTemplate class is an immutable, picklable copy of a parsed sentence
+    captured at ingestion time: the template text, and tuples of the token
+    texts, POS tags, dependency tags, head indices and child indices of every
+    token, plus the index of the sentence's root token. Generation walks these
+    arrays instead of live spaCy tokens, so templates never need re-parsing
+    and can be shared across processes.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_doc(cls, doc, root_idx):
+        """
+        Captures a parsed doc as a template rooted at the given token
+        """
+        children = [[] for token in doc]
+        for token in doc:
+            if token.head.i != token.i:
+                children[token.head.i].append(token.i)
+        return cls(doc.text, tuple(token.text for token in doc), \
+                   tuple(token.tag_ for token in doc), \
+                   tuple(token.dep_ for token in doc), \
+                   tuple(token.head.i for token in doc), \
+                   tuple(tuple(token_children) for token_children in children), \
+                   root_idx)
+
 
 class Sentence():
     """
     Sentence class represents sentences with its text in string form, its list 
-    of word tokens, and the original template of dependency structure that the 
-    sentence was generated based on.
+    of word tokens, the POS tag of each token, and the original template of 
+    dependency structure that the sentence was generated based on. The 
+    sentence's TextBlob polarity and subjectivity are computed on first use 
+    and cached until its text changes.
     """
-    def __init__(self, text, token_list, original_template):
+    def __init__(self, text, token_list, original_template, tag_list):
         self.text = text
         self.token_list = token_list
         self.original_template = original_template
+        self.tag_list = tag_list
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        # only a different text invalidates the cached sentiment
+        if getattr(self, '_text', None) != text:
+            self._text = text
+            self._sentiment = None
+
+    def sentiment(self):
+        """
+        Returns the (polarity, subjectivity) of the sentence
+        """
+        if self._sentiment is None:
+            metrics.SENTIMENT_SCORINGS.inc()
+            sentence_blob = TextBlob(self._text)
+            self._sentiment = (sentence_blob.polarity, \
+                               sentence_blob.subjectivity)
+        return self._sentiment
     
     def __str__(self):
         return self.text
@@ -33,6 +201,7 @@ class Poem():
         self.text = text
         self.sentence_list = sentence_list # list of Sentence objects
         self.num_sentences = len(sentence_list)
+        self.revision_iterations = 0 # sentiment revision steps taken
 
 
     def return_sentence_list_text(self):
@@ -58,72 +227,116 @@ class PoemGenerator():
     PoemGenerator class performs all main features and processes involved in
     the program's poetry generation.
     """
-    def __init__(self):
+    def __init__(self, seed=None):
+        # random number generator of every choice made while generating
+        self.rng = BlockRandom(seed)
         self.inspiring_poems = dict() # file name to inspiring poem string
         self.generated_poems = dict() # poem name to generated poem string
-        self.nlp = spacy.load("en_core_web_sm") # natural language processor
+        # natural language processor shared by all generators
+        self.nlp = nlp_pipeline.get_nlp()
+        # precomputed POS tags and sentiment scores of the vocabulary
+        self.lexicon = lexicon.get_lexicon()
         # list of punctuations to consider for formatting
         self.PUNCTUATIONS = [".", ",", "-RRB-", "''", '""', ':']
-        self.word_deps = dict() # word to dict of (dependency tag to word list)
-        self.word_categories = dict() # POS tag label to word list
+        self.word_deps = dict() # word to dict of (dependency tag to word set)
+        self.word_categories = dict() # POS tag label to word set
         self.templates = [] # dependency tree templates
+        self.templates_by_root_tag = dict() # root's POS tag to template ids
+        self.templates_by_token = dict() # token to ids of templates with it
+        self.templates_by_tag = dict() # POS tag to ids of templates with it
+        self.word_tags = dict() # word to set of its POS tags
+        self.ingestion_stats = dict() # token counts and timings of parsing
         self.polarities = dict() # word to polarity score
         self.subjectivities = dict() # word to subjectivity score
-        self.words_in_inspiring_poems = [] # all vocab from inspiring poems
+        # words of each POS tag sorted by polarity and by subjectivity, built
+        # on first use and dropped whenever a new word is recorded
+        self.score_indexes = None
+        self.words_in_inspiring_poems = IndexedSet() # all vocab from poems
 
 
-    def read_poem_files_to_strings(self):
+    def __getstate__(self):
         """
-        Read files of inspiring poems into dictionary
+        Returns the state sent to candidate workers: everything needed to
+        generate, without the process-wide spaCy pipeline and lexicon, which
+        the workers have their own of, or the texts of the inspiring poems
         """
-        for filename in glob.glob("flaskr/inspiring_poems/*.txt"): 
-            file = open(filename)
-            text = file.read()
-            self.inspiring_poems[filename] = text
+        state = self.__dict__.copy()
+        for name in ['nlp', 'lexicon']:
+            del state[name]
+        state['inspiring_poems'] = dict()
+        state['generated_poems'] = dict()
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.nlp = nlp_pipeline.get_nlp()
+        self.lexicon = lexicon.get_lexicon()
+
+
+    def read_poem_rows(self, row_ids):
+        """
+        Read inspiring poems at the given rows of the corpus into dictionary
+        """
+        poem_corpus = corpus.get_corpus()
+        for row_id in row_ids:
+            self.inspiring_poems[row_id] = poem_corpus.poem(row_id)
 
 
     def parse_word(self, token):
         """
         Updates POS tag dictionary and sentiment dictionaries according to word
         """
-        word = token.text.lower()
-        tag = token.tag_
+        self.record_word(token.text.lower(), token.tag_)
+
+
+    def record_word(self, word, tag):
+        """
+        Adds a word with the given tag to the POS tag dictionary and its scores
+        to the sentiment dictionaries
+        """
         # add to POS tag dictionary
-        if tag in self.word_categories.keys():
-            if word not in self.word_categories[tag]:
-                self.word_categories[tag].append(word)
-        else:
-            self.word_categories[tag] = [word]
+        if tag not in self.word_categories.keys():
+            self.word_categories[tag] = IndexedSet()
+        if self.word_categories[tag].add(word):
+            self.score_indexes = None
+        if word not in self.word_tags.keys():
+            self.word_tags[word] = IndexedSet()
+        self.word_tags[word].add(tag)
 
         # add to sentiment dictionaries
-        word_blob = TextBlob(word)
-        self.polarities[word] = word_blob.polarity
-        self.subjectivities[word] = word_blob.subjectivity
+        if word not in self.polarities.keys():
+            polarity, subjectivity = self.lexicon.sentiment(word)
+            self.polarities[word] = polarity
+            self.subjectivities[word] = subjectivity
     
 
-    def parse_dep_tree(self, root):
-        """
-        Takes in a root token and traces the dependency tree by following the
-        root's children. Updates the dependency and POS tag dictionaries for
-        each word that is parsed.
-        """
-        children = root.children
-        curr_word = root.text
-        if curr_word not in self.word_deps.keys():
-            self.word_deps[curr_word] = dict()
-        deps_dict = self.word_deps[curr_word] # dependency tag to word list
-        self.parse_word(root)
-        # iterate through the current token's children
-        for child in children:
-            next_word = child.text
-            # dependency tag based on the relationship between root and child
-            dep = child.dep_
-            if dep in deps_dict.keys():
-                word_list = deps_dict[dep]
-                if next_word not in deps_dict[dep]: word_list.append(next_word)
-            else:
-                deps_dict[dep] = [next_word]
-            self.parse_dep_tree(child) # recursive call on each child
+    def parse_sentence(self, sentence):
+        """
+        Updates the dependency and POS tag dictionaries and the vocabulary with
+        every token of a parsed sentence. Each token is visited once, in
+        sentence order, and recorded as a child of its head, which covers the
+        whole dependency tree without walking it recursively.
+        """
+        for token in sentence:
+            curr_word = token.text
+            if curr_word not in self.word_deps.keys():
+                self.word_deps[curr_word] = dict()
+            self.parse_word(token)
+            self.words_in_inspiring_poems.add(curr_word)
+
+            # the root is its own head and is nobody's child
+            if token.head.i == token.i:
+                continue
+            head_word = token.head.text
+            if head_word not in self.word_deps.keys():
+                self.word_deps[head_word] = dict()
+            deps_dict = self.word_deps[head_word] # dependency tag to word set
+            # dependency tag based on the relationship between head and child
+            dep = token.dep_
+            if dep not in deps_dict.keys():
+                deps_dict[dep] = IndexedSet()
+            deps_dict[dep].add(curr_word)
 
 
     def parse_themes(self, themes):
@@ -132,58 +345,119 @@ class PoemGenerator():
         part of the inspiring poems
         """
         for theme in themes:
-            doc = self.nlp(theme)
-            for token in doc:
-                self.parse_word(token)
+            for word in theme.split():
+                self.record_word(word.lower(), self.lexicon.tag(word))
 
 
     def parse_inspiring_poems(self):
         """
         Parses all inspiring poems sentence by sentence and updates 
         dictionaries for POS tags and dependency tags, and list for sentence
-        templates.
-        """
-        for _, text in self.inspiring_poems.items():
-            doc = self.nlp(text)
-            # use nlp to separate poem to sentences
-            for sentence in doc.sents:
-                sentence_str = sentence.text.strip()
-                if sentence_str == "":
-                    continue
+        templates. Poems read from corpus rows use their pre-parsed sentences
+        from the corpus index when it has been built.
+        """
+        index = corpus_index.get_index(self.nlp)
+        poems_sentence_docs = []
+        unparsed_texts = []
+        for key, text in self.inspiring_poems.items():
+            sentence_docs = None
+            if index is not None and isinstance(key, int):
+                sentence_docs = index.get_docs(key, self.nlp.vocab)
+            if sentence_docs is None:
+                unparsed_texts.append(text)
+            else:
+                poems_sentence_docs.append(sentence_docs)
 
-                # remove contractions from the sentence
-                expanded_words = []
-                for word in sentence_str.split():
-                    expanded_words.append(contractions.fix(word))
-                sentence_str_without_contractions = \
-                                               " ".join(expanded_words).lower()
-                
-                doc_sent = self.nlp(sentence_str_without_contractions)
+        # parse the poems missing from the index together
+        start = time.perf_counter()
+        poems_sentence_docs += parse_poem_sentences(unparsed_texts)
+        parse_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        num_tokens = 0
+        for sentence_docs in poems_sentence_docs:
+            for doc_sent in sentence_docs:
                 for updated_sentence in doc_sent.sents:
-                    for token in updated_sentence:
-                        # parse each token in the sentence
-                        root = updated_sentence.root
-                        self.parse_dep_tree(root)
-                        self.parse_word(token)
-                        self.words_in_inspiring_poems.append(token.text)
-                    
+                    # parse each token in the sentence
+                    self.parse_sentence(updated_sentence)
+                    num_tokens += len(updated_sentence)
+
                     # add sentence to the templates list along with the root
-                    self.templates.append((sentence_str_without_contractions, \
-                                                                        root))
+                    template = SentenceTemplate.from_doc(doc_sent, \
+                                                    updated_sentence.root.i)
+                    self.add_template(template, updated_sentence)
+        ingest_seconds = time.perf_counter() - start
+
+        self.ingestion_stats = {
+            'poems' : len(poems_sentence_docs),
+            'poems_parsed_live' : len(unparsed_texts),
+            'tokens' : num_tokens,
+            'parse_seconds' : parse_seconds,
+            'ingest_seconds' : ingest_seconds,
+            'tokens_per_second' : num_tokens / max(ingest_seconds, 1e-9),
+        }
+        metrics.INGESTED_TOKENS.observe(num_tokens)
+        logger.info("Ingested %d tokens of %d poems at %.0f tokens/s " \
+                    "(%d poems parsed live in %.2fs)", num_tokens, \
+                    len(poems_sentence_docs), \
+                    self.ingestion_stats['tokens_per_second'], \
+                    len(unparsed_texts), parse_seconds)
+
+
+    def add_template(self, template, sentence):
+        """
+        Adds a sentence template and records its id in the indexes by root tag,
+        by contained token and by contained tag.
+        """
+        template_id = len(self.templates)
+        self.templates.append(template)
+
+        root_tag = template.tags[template.root]
+        if root_tag not in self.templates_by_root_tag.keys():
+            self.templates_by_root_tag[root_tag] = []
+        self.templates_by_root_tag[root_tag].append(template_id)
+
+        for token in sentence:
+            if token.text not in self.templates_by_token.keys():
+                self.templates_by_token[token.text] = IndexedSet()
+            self.templates_by_token[token.text].add(template_id)
+            if token.tag_ not in self.templates_by_tag.keys():
+                self.templates_by_tag[token.tag_] = IndexedSet()
+            self.templates_by_tag[token.tag_].add(template_id)
+
+
+    def choose_template_for_root(self, word):
+        """
+        Returns the id of a random template whose root has one of the tags of
+        the given word, or of any template if there is none. Each template has
+        a single root tag, so the per-tag lists never overlap and the choice
+        is uniform over all matching templates.
+        """
+        tag_lists = [self.templates_by_root_tag[tag] for tag in \
+                     self.word_tags.get(word, []) if tag in \
+                     self.templates_by_root_tag.keys()]
+        num_matches = sum(len(template_ids) for template_ids in tag_lists)
+        if num_matches == 0:
+            return self.rng.randrange(len(self.templates))
+
+        position = self.rng.randrange(num_matches)
+        for template_ids in tag_lists:
+            if position < len(template_ids):
+                return template_ids[position]
+            position -= len(template_ids)
         
     
-    def choose_new_child_word(self, child, child_tag, curr_word, new_root_word):
+    def choose_new_child_word(self, dep, child_tag, curr_word, new_root_word):
         """
         Selects a new replacement word
         """
-        dep = child.dep_
         # small probability of choosing any word that matches the original 
         # child's tag and larger probability of choosing word from words that 
         # have the same dependency relationship with the parent word
-        random = npc([True, False], p=[0.2, 0.8])
+        random = self.rng.chance(0.2)
         new_child_word = ""
         if random or new_root_word not in self.word_deps.keys():
-            new_child_word = choice(self.word_categories[child_tag])
+            new_child_word = self.rng.choice(self.word_categories[child_tag])
         else:
             # if new root word has an entry in word_deps
             if dep in self.word_deps[new_root_word].keys():	
@@ -198,78 +472,59 @@ class PoemGenerator():
             
             # if nothing matches, choose from any word to matches the tag
             if len(updated_word_choices) == 0:
-                new_child_word = choice(self.word_categories[child_tag])
+                new_child_word = self.rng.choice\
+                                            (self.word_categories[child_tag])
             else:
-                new_child_word = choice(updated_word_choices)
+                new_child_word = self.rng.choice(updated_word_choices)
         return new_child_word
 
 
-    def generate_sentence_from_root(self, root, new_root_word, str_template, \
-                                                                  token_list):
+    def generate_sentence_from_root(self, template, new_root_word, \
+                                                    token_list, themes=()):
         """
-        Takes in a theme word and generates a new sentence using given
-        string template and the theme as the root.
+        Takes in a new root word and generates a new sentence from the given
+        template, choosing a new word for every token below the root. Tokens
+        whose original word is one of the given themes keep that word.
         """
-        children = root.children
-        curr_word = root.text
-        token_list[root.i] = new_root_word
-        str_template = " ".join(token_list)
-        new_sentence = Sentence(str_template, token_list, str_template)
-        for child in children:
+        token_list[template.root] = new_root_word
+
+        # walk the dependency tree depth-first, children in sentence order;
+        # each entry is a token with its parent's original and new words
+        stack = [(child, template.words[template.root], new_root_word) for \
+                 child in reversed(template.children[template.root])]
+        while len(stack) > 0:
+            idx, curr_word, new_parent_word = stack.pop()
             # choose a new word for each child
-            child_tag = child.tag_
-            if child_tag == "_SP":
-                continue
-            new_child_word = self.choose_new_child_word(child, child_tag, \
-                                                    curr_word, new_root_word)
-            # recursive call with child as new root
-            new_sentence = self.generate_sentence_from_root\
-                            (child, new_child_word, str_template, token_list)
-        return new_sentence
-    
-
-    def generate_sentence_with_themes(self, root, new_root_word, themes, \
-                                                str_template, token_list):
-        """
-        Takes a new root word and generates a new sentence with a string
-        template that 
-        """
-        children = root.children
-        curr_word = root.text
-        token_list[root.i] = new_root_word
-        str_template = " ".join(token_list)
-        new_sentence = Sentence(str_template, token_list, str_template)
-        for child in children:
-            child_tag = child.tag_
+            child_tag = template.tags[idx]
             if child_tag == "_SP":
                 continue
-            # skip over any theme word so that it remains in the sentence
-            if child.text in themes:
-                str_template = self.generate_sentence_with_themes\
-                        (child, child.text, themes, str_template, token_list)
-                continue
-            new_child_word = self.choose_new_child_word(child, child_tag, \
-                                                    curr_word, new_root_word)
-            new_sentence = self.generate_sentence_with_themes\
-                    (child, new_child_word, themes, str_template, token_list)
-        return new_sentence
+            # keep any theme word so that it remains in the sentence
+            if template.words[idx] in themes:
+                new_child_word = template.words[idx]
+            else:
+                new_child_word = self.choose_new_child_word\
+                                (template.deps[idx], child_tag, curr_word, \
+                                 new_parent_word)
+            token_list[idx] = new_child_word
+            stack.extend((child, template.words[idx], new_child_word) for \
+                         child in reversed(template.children[idx]))
+
+        return Sentence(" ".join(token_list), token_list, template.text, \
+                        list(template.tags))
     
 
     def add_theme_to_sentence(self, theme_word, theme_tag, themes, sentence):
         """
         Add a theme word to a given sentence without changing the rest of it
         """
-        str_template = sentence.text
         token_list = sentence.token_list
-        doc = self.nlp(str_template)
-        idx = 0
-        for token in doc:
+        for idx in range(len(token_list)):
             # change a word with the same tag as the theme word to the theme
-            if token.tag_ == theme_tag and token.text not in themes:
+            if sentence.tag_list[idx] == theme_tag and \
+                                            token_list[idx] not in themes:
                 token_list[idx] = theme_word
                 break
-            idx += 1
-            
+
         str_template = " ".join(token_list)
 
         sentence.text = str_template
@@ -278,18 +533,17 @@ class PoemGenerator():
         return sentence
 
 
-    def get_sentence_template(self, template_choices):
+    def get_sentence_template(self, template_ids=None):
         """
-        Chooses a random sentence template and returns it with the root and
-        token list.
+        Chooses a random sentence template out of the given template ids (or
+        out of all templates) and returns it with a fresh token list.
         """
-        sentence, root = choice(template_choices)
-        sentence_doc = self.nlp(sentence)
-        token_list = []
-        for token in sentence_doc:
-            token_list.append(token.text)
-            
-        return (root, sentence, token_list)
+        if template_ids is None or len(template_ids) == 0:
+            template_id = self.rng.randrange(len(self.templates))
+        else:
+            template_id = self.rng.choice(template_ids)
+        template = self.templates[template_id]
+        return (template, list(template.words))
     
 
     def reformat_name(self, name):
@@ -466,99 +720,234 @@ class PoemGenerator():
         """
         Selects a random sequence of words from the poem to be the poem's name.
         """
-        sentence = choice(sentence_list).token_list
+        sentence = self.rng.choice(sentence_list).token_list
         sentence_len = len(sentence)
         # set the max length of name at 8 words
-        name_len = randint(1, 8) if sentence_len >= 8 \
-                                 else randint(1, sentence_len)
-        start_idx = randint(0, sentence_len-name_len)
+        name_len = self.rng.randint(1, 8) if sentence_len >= 8 \
+                                 else self.rng.randint(1, sentence_len)
+        start_idx = self.rng.randint(0, sentence_len-name_len)
         name_list = sentence[start_idx : start_idx + name_len]
         return " ".join(name_list)
 
 
-    def generate_poem(self, num_sents, themes):
+    def generate_sentences(self, num_sents, themes):
         """
-        Generates a new poem given the number of sentences and the list of
-        inspiring themes.
+        Generates the given number of new sentences for a poem inspired by the
+        list of themes, yielding each sentence as soon as it is generated.
         """
-        new_poem_list = []
-
         # add option to not include any theme word in sentence
         theme_choices = themes + [None] 
         
         for i in range(num_sents):
             new_sentence = None
-            theme_word = choice(theme_choices) # choose random theme word
+            # choose random theme word
+            theme_word = self.rng.choice(theme_choices)
 
             # generate sentence without consideration for theme words
             if theme_word == None: 
-                root, sentence, token_list = self.get_sentence_template\
-                                                        (self.templates)
-                new_root_word = choice(self.word_categories[root.tag_])
+                template, token_list = self.get_sentence_template()
+                new_root_word = self.rng.choice(self.word_categories\
+                                       [template.tags[template.root]])
                 new_sentence = self.generate_sentence_from_root\
-                                    (root, new_root_word, sentence, token_list)
-                new_sentence.original_template = sentence
+                                    (template, new_root_word, token_list)
             
             # if theme word isn't in the inspiring poems
             elif theme_word not in self.words_in_inspiring_poems: 
-                root, sentence, token_list = self.get_sentence_template\
-                                                        (self.templates)
-                new_root_word = choice(self.word_categories[root.tag_])
+                # choose a template with a word that the theme can replace
+                theme_tag = self.lexicon.tag(theme_word.split()[-1])
+                template, token_list = self.get_sentence_template\
+                                    (self.templates_by_tag.get(theme_tag))
+                new_root_word = self.rng.choice(self.word_categories\
+                                       [template.tags[template.root]])
                 new_sentence = self.generate_sentence_from_root\
-                                    (root, new_root_word, sentence, token_list)
-                theme_doc = self.nlp(theme_word)
-                theme_tag = ""
-                for token in theme_doc:
-                    theme_tag = token.tag_
+                                    (template, new_root_word, token_list)
                 new_sentence = self.add_theme_to_sentence\
                                     (theme_word, theme_tag, [], new_sentence)
-                new_sentence.original_template = sentence
 
             else: # generate sentence including at least one theme word
-                option = choice(["root", "with"])
+                option = self.rng.choice(["root", "with"])
                 if option == "root": # inspiring word as root of sentence
                     # choose random template whose root has same tag as theme
-                    updated_templates = [template for template in \
-                                        self.templates if theme_word in \
-                                        self.word_categories[template[1].tag_]]
-                    root, sentence, token_list = self.get_sentence_template\
-                                                        (updated_templates)
+                    template_id = self.choose_template_for_root(theme_word)
+                    template, token_list = self.get_sentence_template\
+                                                        ([template_id])
                     new_sentence = self.generate_sentence_from_root\
-                                    (root, theme_word, sentence, token_list)
-                    new_sentence.original_template = sentence
+                                    (template, theme_word, token_list)
                 else: # inspiring word kept at original position in sentence
                     # find sentence templates containing theme word
-                    templates_with_word = [template for template in \
-                                          self.templates if theme_word \
-                                          in template[0]]   
-                    root, sentence, token_list = self.get_sentence_template\
-                                                        (templates_with_word)
+                    template, token_list = self.get_sentence_template\
+                                    (self.templates_by_token.get(theme_word))
                     # choose random new root word
-                    new_root_word = choice(self.word_categories[root.tag_])
-                    new_sentence = self.generate_sentence_with_themes\
-                                    (root, new_root_word, \
-                                    [theme_word], sentence, token_list)
-                    new_sentence.original_template = sentence
+                    new_root_word = self.rng.choice(self.word_categories\
+                                           [template.tags[template.root]])
+                    new_sentence = self.generate_sentence_from_root\
+                                    (template, new_root_word, token_list, \
+                                    [theme_word])
+
+            yield new_sentence
 
-            new_poem_list.append(new_sentence)
-            
-        new_poem_str = "\n".join([sentence.text for sentence in new_poem_list])
+
+    def new_poem(self, sentence_list, themes):
+        """
+        Creates a new poem with a unique name from the given list of sentences.
+        """
+        new_poem_str = "\n".join([sentence.text for sentence in sentence_list])
 
         # generate a name for the poem
         name = ""
         is_unique_name = False
         while not is_unique_name:
-            name = self.name_poem(new_poem_list)
+            name = self.name_poem(sentence_list)
             if name not in self.generated_poems.keys():
                 is_unique_name = True
 
         # create new Poem object
-        new_poem_object = Poem(name, themes, new_poem_str, new_poem_list)
+        new_poem_object = Poem(name, themes, new_poem_str, sentence_list)
 
         self.generated_poems[name] = new_poem_object
 
         return new_poem_object
-    
+
+
+    def generate_poem(self, num_sents, themes):
+        """
+        Generates a new poem given the number of sentences and the list of
+        inspiring themes.
+        """
+        new_poem_list = list(self.generate_sentences(num_sents, themes))
+        return self.new_poem(new_poem_list, themes)
+
+
+    def revise_poem(self, poem):
+        """
+        Revises the poem so that it includes the themes and has a stronger
+        polarity and subjectivity than it started with, yielding the name of
+        each revision step with the poem after it.
+        """
+        themed_poem = self.improve_poem_themes(poem)
+        yield 'themes', themed_poem
+
+        avg_pol, avg_sub = self.evaluate_sentiment(themed_poem)
+
+        goal_pol = (avg_pol + 0.01) * 1.05
+        goal_sub = (avg_sub + 0.01) * 1.05
+
+        yield 'sentiment', self.improve_poem_sentiment\
+                                    (themed_poem, goal_pol, goal_sub)
+
+
+    def generate_revised_poem(self, num_sents, themes):
+        """
+        Generates a new poem and applies every revision step to it.
+        """
+        poem = self.generate_poem(num_sents, themes)
+        for _, poem in self.revise_poem(poem):
+            pass
+        return poem
+
+
+    def generate_seeded_poem(self, seed, num_sents, themes):
+        """
+        Generates a revised candidate poem from its own seed. Each candidate
+        starts with no generated poems, as in a freshly unpickled worker copy,
+        so that its poem depends only on its seed and not on the candidates
+        generated before it in the same process.
+        """
+        self.rng.seed(seed)
+        self.generated_poems = dict()
+        return self.generate_revised_poem(num_sents, themes)
+
+
+    def score_poem(self, poem):
+        """
+        Scores a candidate poem by the fraction of themes it contains plus the
+        strength of its polarity and subjectivity, each between 0 and 1.
+        """
+        _, themes_in_poem, _ = self.check_poem_themes(poem)
+        theme_coverage = 1.0
+        if len(themes_in_poem) > 0:
+            theme_coverage = sum(themes_in_poem) / len(themes_in_poem)
+
+        avg_pol, avg_sub = self.evaluate_sentiment(poem)
+        return theme_coverage + (abs(avg_pol) + avg_sub) / 2
+
+
+    def generate_candidates(self, n, num_sents, themes, budget_seconds=None):
+        """
+        Generates up to n revised candidate poems, in parallel on the
+        candidate pool if it was started, and returns the one with the best
+        score. The number of candidates and the wall-clock budget are capped
+        at the configured maxima. Candidates still unfinished once the budget
+        is spent are abandoned; if none finished in time, one is generated
+        here instead, so a poem is always returned. Workers finish the
+        candidate they are on, but skip candidates of expired requests.
+        """
+        start = time.perf_counter()
+        n = max(1, min(n, config['max_candidates']))
+        if budget_seconds is None:
+            budget_seconds = config['max_budget_seconds']
+        budget_seconds = max(0, min(budget_seconds, \
+                                    config['max_budget_seconds']))
+        deadline = start + budget_seconds
+
+        # each candidate gets its own seed, so that the same candidates are
+        # generated whether or not they run in parallel, and the generator
+        # continues from one more seed afterwards, whichever way they ran
+        seeds = [self.rng.spawn_seed() for candidate_idx in range(n)]
+        next_seed = self.rng.spawn_seed()
+        generated_poems = self.generated_poems
+
+        candidates = []
+        processes = 1
+        if n > 1 and _candidate_pool is not None:
+            processes = min(n, _candidate_pool_size)
+            # workers get the generator with its score indexes already built,
+            # pickled once for all of them
+            self.get_score_indexes()
+            state = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+            state_id = secrets.token_hex(8)
+            wall_deadline = time.time() + budget_seconds
+            tasks = [(candidate_idx, seed, num_sents, themes, state_id, \
+                      state, wall_deadline) \
+                     for candidate_idx, seed in enumerate(seeds)]
+            results = _candidate_pool.imap_unordered(generate_candidate, \
+                                                     tasks)
+            for i in range(n):
+                timeout = max(0, deadline - time.perf_counter())
+                try:
+                    candidate_idx, poem = results.next(timeout)
+                except multiprocessing.TimeoutError:
+                    break
+                if poem is not None:
+                    candidates.append((candidate_idx, poem))
+        else:
+            for candidate_idx, seed in enumerate(seeds):
+                if len(candidates) > 0 and time.perf_counter() >= deadline:
+                    break
+                candidates.append((candidate_idx, \
+                        self.generate_seeded_poem(seed, num_sents, themes)))
+
+        if len(candidates) == 0:
+            logger.warning("No candidate poem finished within %.2fs, " \
+                           "generating one in process", budget_seconds)
+            candidates.append((0, self.generate_seeded_poem(seeds[0], \
+                                                    num_sents, themes)))
+
+        # compare candidates in a fixed order, whichever finished first
+        candidates = [poem for _, poem in sorted(candidates, \
+                                            key=lambda candidate: candidate[0])]
+        scores = [self.score_poem(poem) for poem in candidates]
+        best_poem = candidates[scores.index(max(scores))]
+        self.generated_poems = generated_poems
+        self.generated_poems[best_poem.name] = best_poem
+        self.rng.seed(next_seed)
+
+        metrics.GENERATION_CANDIDATES.observe(len(candidates))
+        logger.info("Chose best of %d/%d candidate poems (score %.3f) in " \
+                    "%.2fs with %d processes", len(candidates), n, \
+                    max(scores), time.perf_counter() - start, processes)
+        return best_poem
+
 
     def check_poem_themes(self, poem):
         """
@@ -634,22 +1023,22 @@ class PoemGenerator():
             # if there are sentences without any theme, prioritize changing 
             # them to add themes
             if len(sentences_with_no_theme) > 0:
-                selected_sentence_num = choice(sentences_with_no_theme)
-                root, sentence, token_list = self.get_sentence_template\
-                                                        (self.templates)
-                new_sentence = self.generate_sentence_from_root(root, theme, \
-                                                         sentence, token_list)
+                selected_sentence_num = self.rng.choice\
+                                                    (sentences_with_no_theme)
+                # choose a template whose root has the same tag as the theme
+                template_id = self.choose_template_for_root(theme)
+                template, token_list = self.get_sentence_template\
+                                                        ([template_id])
+                new_sentence = self.generate_sentence_from_root(template, \
+                                                        theme, token_list)
                 sentences_with_no_theme.remove(selected_sentence_num)
 
             # if all sentences already have at least one theme
             else:
                 # select a sentence to be modified
-                selected_sentence = choice(sentence_list)
+                selected_sentence = self.rng.choice(sentence_list)
                 selected_sentence_num = sentence_list.index(selected_sentence)
-                theme_doc = self.nlp(theme)
-                theme_tag = ""
-                for token in theme_doc:
-                    theme_tag = token.tag_
+                theme_tag = self.lexicon.tag(theme.split()[-1])
                 # keep the sentence but replace one word with the new theme
                 new_sentence = self.add_theme_to_sentence(theme, theme_tag, \
                                                     themes, selected_sentence)
@@ -665,113 +1054,114 @@ class PoemGenerator():
     
     def evaluate_sentiment(self, poem):
         """
-        Calculates the average polarity and subjectivity of the poem.
+        Calculates the average polarity and subjectivity of the poem. Only 
+        sentences whose text changed since they were last scored are passed
+        through TextBlob again.
         """
         sum_polarity = 0
         sum_subjectivitiy = 0
         for sentence_obj in poem.sentence_list:
-            sentence = sentence_obj.text
-            sentence_blob = TextBlob(sentence)
-            sent_doc = self.nlp(sentence)
-            sum_pol = 0
-            for token in sent_doc:
-                token_blob = TextBlob(token.text)
-                token_pol = token_blob.polarity
-                sum_pol += token_pol
-            sum_polarity += sentence_blob.polarity
-            sum_subjectivitiy += sentence_blob.subjectivity
+            polarity, subjectivity = sentence_obj.sentiment()
+            sum_polarity += polarity
+            sum_subjectivitiy += subjectivity
         avg_polarity = sum_polarity / poem.num_sentences
         avg_subjectivity = sum_subjectivitiy / poem.num_sentences
         return avg_polarity, avg_subjectivity
 
 
-    def improve_word_sentiment(self, token_list, sentiment_dict, curr_avg):
+    def get_score_indexes(self):
+        """
+        Returns the polarity and subjectivity ScoreIndex of the vocabulary
+        """
+        if self.score_indexes is None:
+            self.score_indexes = \
+                (ScoreIndex(self.word_categories, self.polarities), \
+                 ScoreIndex(self.word_categories, self.subjectivities))
+        return self.score_indexes
+
+
+    def improve_word_sentiment(self, sentence, score_index, sentiment_dict, \
+                               curr_avg):
         """
         Takes a sentence and selects a new replacement word with a higher 
         sentiment value than that of the current word. Could be used for 
-        polarity or subjectivity depending on which sentiment dictionary is 
-        given.
+        polarity or subjectivity depending on which score index and sentiment
+        dictionary are given.
         """
+        token_list = sentence.token_list
+
         # stores whether overall sentiment is positive or negative
         positive = True
         if curr_avg < 0:
             positive = False
 
-        word_chosen = False
-        while not word_chosen:
-            idx = randint(0, len(token_list)-1)
-            curr_word = token_list[idx]
-
-            doc = self.nlp(curr_word)
-            tag = ""
-            for token in doc:
-                tag = token.tag_
+        # only choose words whose tag is in the POS tag dictionary
+        positions = [idx for idx, tag in enumerate(sentence.tag_list) if \
+                     tag in self.word_categories.keys()]
+        if len(positions) == 0:
+            return token_list
+        idx = self.rng.choice(positions)
+        curr_word = token_list[idx]
+        tag = sentence.tag_list[idx]
 
-            # only choose the word if its tag is in the POS tag dictionary
-            if tag in self.word_categories.keys():
-                word_chosen = True
-        
-        words_with_tag = self.word_categories[tag]
+        # if the current word has no sentiment value, don't update sentence
+        if curr_word not in sentiment_dict.keys():
+            return token_list
 
         if positive:
             # new word choices only include those with higher sentiment value
-            try:
-                word_choices = [word for word in words_with_tag if \
-                            sentiment_dict[word] > sentiment_dict[curr_word]]
-            except KeyError:
-                word_choices = [curr_word]
+            start, end = score_index.range_above(tag, sentiment_dict[curr_word])
         else:
             # new word choices only include those with lower sentiment value
-            try:
-                word_choices = [word for word in words_with_tag if \
-                            sentiment_dict[word] < sentiment_dict[curr_word]]
-            except KeyError:
-                word_choices = [curr_word]
+            start, end = score_index.range_below(tag, sentiment_dict[curr_word])
 
         # if no word choice has better sentiment value, don't update sentence
-        if len(word_choices) == 0:
+        if start == end:
             return token_list
 
-        new_word = choice(word_choices)
+        new_word = score_index.words[tag]\
+                                    [start + self.rng.randrange(end - start)]
         
         token_list[idx] = new_word
 
         return token_list
 
 
-    def improve_poem_sentiment(self, poem, goal_pol, goal_sub):
+    def improve_poem_sentiment(self, poem, goal_pol, goal_sub, \
+                               max_iterations=None):
         """
         Revises the poem so that the polarity and subjectivity of the poem
-        reach the given goals.
+        reach the given goals, in at most max_iterations steps (by default the
+        configured max_revisions).
         """
+        if max_iterations is None:
+            max_iterations = config['max_revisions']
         new_sentence_list = poem.sentence_list.copy()
+        pol_index, sub_index = self.get_score_indexes()
 
         avg_pol, avg_sub = self.evaluate_sentiment(poem)
 
         counter = 0
 
-        # max 10 times to avoid infinite loop
+        # limit the number of steps to avoid infinite loop
         while (abs(avg_pol) < abs(goal_pol) or abs(avg_sub) < abs(goal_sub)) \
-                and counter < 10:
+                and counter < max_iterations:
             counter += 1
 
             # choose a sentence to revise to increase polarity
-            pol_sentence = choice(new_sentence_list)
-            pol_idx = new_sentence_list.index(pol_sentence)
+            pol_sentence = self.rng.choice(new_sentence_list)
             new_pol_token_list = self.improve_word_sentiment\
-                            (pol_sentence.token_list, self.polarities, avg_pol)
-            new_pol_sentence = Sentence(" ".join(new_pol_token_list), \
-                            new_pol_token_list, pol_sentence.original_template)
-            new_sentence_list[pol_idx] = new_pol_sentence
+                    (pol_sentence, pol_index, self.polarities, avg_pol)
+            # revise in place so an unchanged sentence keeps its scores
+            pol_sentence.token_list = new_pol_token_list
+            pol_sentence.text = " ".join(new_pol_token_list)
 
             # choose a sentence to revise to increase subjectivity
-            sub_sentence = choice(new_sentence_list)
-            sub_idx = new_sentence_list.index(sub_sentence)
+            sub_sentence = self.rng.choice(new_sentence_list)
             new_sub_token_list = self.improve_word_sentiment\
-                        (sub_sentence.token_list, self.subjectivities, avg_sub)
-            new_sub_sentence = Sentence(" ".join(new_sub_token_list), \
-                            new_sub_token_list, sub_sentence.original_template)
-            new_sentence_list[sub_idx] = new_sub_sentence
+                    (sub_sentence, sub_index, self.subjectivities, avg_sub)
+            sub_sentence.token_list = new_sub_token_list
+            sub_sentence.text = " ".join(new_sub_token_list)
 
             poem.sentence_list = new_sentence_list
             poem.join_list_to_text()
@@ -779,4 +1169,5 @@ class PoemGenerator():
             # calculate new average sentiment values
             avg_pol, avg_sub = self.evaluate_sentiment(poem)
 
+        poem.revision_iterations += counter
         return poem
\ No newline at end of file
@@ -0,0 +1,90 @@
+import secrets
+import numpy as np
+
+
+class BlockRandom():
+    """
+    BlockRandom class is a seedable random number generator for the
+    generation hot loop. Uniform floats are drawn from a NumPy generator a
+    whole block at a time, which is vectorized, and then handed out one by one
+    as plain Python floats, so a single coin flip or choice costs a list
+    lookup instead of a NumPy call. The same seed always yields the same
+    sequence of draws.
+    """
+    def __init__(self, seed=None, block_size=4096):
+        self.block_size = block_size
+        self.seed(seed)
+
+
+    def seed(self, seed=None):
+        """
+        Restarts the sequence from the given seed, or from a new random seed
+        if none is given. The seed in use is kept in seed_value.
+        """
+        if seed is None:
+            seed = secrets.randbits(32)
+        self.seed_value = seed
+        self.generator = np.random.default_rng(seed)
+        self.block = []
+        self.position = 0
+
+
+    def random(self):
+        """
+        Returns a uniform float in [0, 1)
+        """
+        if self.position == len(self.block):
+            self.block = self.generator.random(self.block_size).tolist()
+            self.position = 0
+        value = self.block[self.position]
+        self.position += 1
+        return value
+
+
+    def chance(self, probability):
+        """
+        Returns True with the given probability
+        """
+        return self.random() < probability
+
+
+    def randrange(self, stop):
+        """
+        Returns a random int in [0, stop)
+        """
+        return int(self.random() * stop)
+
+
+    def randint(self, low, high):
+        """
+        Returns a random int in [low, high], both included
+        """
+        return low + self.randrange(high - low + 1)
+
+
+    def choice(self, seq):
+        """
+        Returns a random item of a non-empty sequence
+        """
+        if len(seq) == 0:
+            raise IndexError("Cannot choose from an empty sequence")
+        return seq[self.randrange(len(seq))]
+
+
+    def sample(self, population, k):
+        """
+        Returns k distinct random items of a sequence, in the order drawn
+        """
+        chosen = dict() # position to item, in the order drawn
+        while len(chosen) < min(k, len(population)):
+            position = self.randrange(len(population))
+            if position not in chosen.keys():
+                chosen[position] = population[position]
+        return list(chosen.values())
+
+
+    def spawn_seed(self):
+        """
+        Returns a new seed drawn from this generator, e.g. for a worker
+        """
+        return self.randrange(2**32)
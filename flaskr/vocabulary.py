@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class IndexedSet():
+    """
+    IndexedSet class is a set of words that also keeps its items in a list, with
+    a dictionary from each item to its position in the list. Adding, membership
+    tests and uniform random choice all take constant time. It supports len()
+    and indexing, so random.choice() works on it directly.
+    """
+    def __init__(self, items=()):
+        self.items = [] # items in insertion order
+        self.positions = dict() # item to its position in the items list
+        for item in items:
+            self.add(item)
+
+
+    def add(self, item):
+        """
+        Adds an item if it is not already in the set. Returns whether it was
+        added.
+        """
+        if item in self.positions:
+            return False
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+        return True
+
+
+    def __contains__(self, item):
+        return item in self.positions
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def __getitem__(self, position):
+        return self.items[position]
+
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+    def __repr__(self):
+        return f"IndexedSet({self.items!r})"
+
+
+class ScoreIndex():
+    """
+    ScoreIndex class keeps the words of each POS tag sorted by a sentiment
+    score, with the sorted scores in a NumPy array, so that the words of a tag
+    scoring above or below a value are found with a binary search and form a
+    contiguous range to pick from at random.
+    """
+    def __init__(self, word_categories, scores):
+        self.words = dict() # POS tag to list of words sorted by score
+        self.scores = dict() # POS tag to sorted array of their scores
+        for tag, words in word_categories.items():
+            scored_words = [word for word in words if word in scores]
+            tag_scores = np.array([scores[word] for word in scored_words], \
+                                  dtype=np.float64)
+            order = np.argsort(tag_scores, kind='stable')
+            self.words[tag] = [scored_words[i] for i in order]
+            self.scores[tag] = tag_scores[order]
+
+
+    def range_above(self, tag, score):
+        """
+        Returns the (start, end) positions of the words of a tag whose score
+        is higher than the given score
+        """
+        tag_scores = self.scores.get(tag)
+        if tag_scores is None:
+            return 0, 0
+        return int(np.searchsorted(tag_scores, score, side='right')), \
+               len(tag_scores)
+
+
+    def range_below(self, tag, score):
+        """
+        Returns the (start, end) positions of the words of a tag whose score
+        is lower than the given score
+        """
+        tag_scores = self.scores.get(tag)
+        if tag_scores is None:
+            return 0, 0
+        return 0, int(np.searchsorted(tag_scores, score, side='left'))
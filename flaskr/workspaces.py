@@ -0,0 +1,237 @@
+import os
+import glob
+import json
+import time
+import shutil
+import secrets
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# workspace settings, changed with configure()
+config = {
+    'root' : os.path.join(tempfile.gettempdir(), 'flaskr-workspaces'),
+    'ttl_seconds' : 3600,
+    # longest wait for the pending detections of a workspace, after which
+    # they are assumed lost, e.g. with a worker that was stopped
+    'detection_timeout_seconds' : 300,
+}
+
+# generation checks this often whether pending detections have finished
+DETECTION_POLL_SECONDS = 0.2
+
+# workspaces unused for ttl_seconds are removed, checked at most this often
+CLEANUP_INTERVAL_SECONDS = 60
+
+_last_cleanup = 0
+_cleanup_lock = threading.Lock()
+
+
+class Workspace():
+    """
+    Workspace class represents the private folder of one user session, which
+    holds the objects detected in the images they uploaded and the row ids of
+    the inspiring poems chosen for them, so that concurrent users never see or
+    reset each other's files. The folder's modification time records when it
+    was last used. Files are written whole and moved into place, and each
+    upload's results go to a file of their own, so that concurrent requests
+    of the same session never read a partial file or lose results.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.rows_path = os.path.join(folder, 'rows.json')
+
+
+    def touch(self):
+        """
+        Marks the workspace as used now, creating its folder if needed
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        os.utime(self.folder)
+
+
+    def write_json(self, path, data):
+        """
+        Writes data as JSON to a temporary file and moves it to the path
+        """
+        temp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(temp_path, 'w') as temp_file:
+            json.dump(data, temp_file)
+        os.replace(temp_path, path)
+
+
+    def results_paths(self):
+        """
+        Returns the paths of the detection results of each upload, oldest
+        first
+        """
+        return sorted(glob.glob(os.path.join(self.folder, \
+                                             'detections-*.json')))
+
+
+    def clear(self):
+        """
+        Removes the detected objects and chosen inspiring poems
+        """
+        for path in self.results_paths() + [self.rows_path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.touch()
+
+
+    def add_image_results(self, image_results):
+        """
+        Stores the (labels, scores) detected in newly uploaded images
+        """
+        path = os.path.join(self.folder, f"detections-{time.time_ns():020d}" \
+                                         f"-{secrets.token_hex(4)}.json")
+        self.write_json(path, [[labels, scores] for labels, scores in \
+                               image_results])
+
+
+    def start_detection(self):
+        """
+        Marks the detection of newly uploaded images as pending and returns
+        the id of the mark, to be passed to finish_detection once their
+        results are stored
+        """
+        detection_id = secrets.token_hex(8)
+        self.touch()
+        with open(os.path.join(self.folder, f"pending-{detection_id}"), 'w'):
+            pass
+        return detection_id
+
+
+    def finish_detection(self, detection_id):
+        """
+        Removes the pending mark of a detection
+        """
+        try:
+            os.remove(os.path.join(self.folder, f"pending-{detection_id}"))
+        except FileNotFoundError:
+            pass
+
+
+    def wait_for_detections(self):
+        """
+        Waits until the detections of every uploaded image have finished, or
+        for at most detection_timeout_seconds. Marks older than that are
+        ignored. Returns whether no detection is pending anymore.
+        """
+        timeout_seconds = config['detection_timeout_seconds']
+        deadline = time.time() + timeout_seconds
+        while True:
+            now = time.time()
+            pending = False
+            for path in glob.glob(os.path.join(self.folder, 'pending-*')):
+                try:
+                    if now - os.path.getmtime(path) < timeout_seconds:
+                        pending = True
+                except FileNotFoundError:
+                    # finished in the meantime
+                    pass
+            if not pending:
+                return True
+            if now >= deadline:
+                return False
+            time.sleep(DETECTION_POLL_SECONDS)
+
+
+    def read_image_results(self):
+        """
+        Returns the (labels, scores) detected in each uploaded image, in the
+        order they were uploaded
+        """
+        image_results = []
+        for path in self.results_paths():
+            try:
+                with open(path) as results_file:
+                    image_results += [tuple(result) for result in \
+                                      json.load(results_file)]
+            except FileNotFoundError:
+                # cleared in the meantime
+                pass
+        return image_results
+
+
+    def save_rows(self, row_ids):
+        """
+        Stores the row ids of the chosen inspiring poems
+        """
+        self.write_json(self.rows_path, [int(row_id) for row_id in row_ids])
+
+
+    def read_rows(self):
+        """
+        Returns the row ids of the chosen inspiring poems, or None if no poems
+        have been chosen yet.
+        """
+        if not os.path.exists(self.rows_path):
+            return None
+        with open(self.rows_path) as rows_file:
+            return json.load(rows_file)
+
+
+def configure(**settings):
+    """
+    Updates the workspace settings
+    """
+    config.update(settings)
+
+
+def new_workspace_id():
+    """
+    Returns a new random workspace id
+    """
+    return secrets.token_hex(16)
+
+
+def is_valid_id(workspace_id):
+    """
+    Checks that a workspace id, e.g. from a cookie, is one we could have made,
+    so that it is safe to use as a folder name.
+    """
+    if workspace_id is None or len(workspace_id) != 32:
+        return False
+    return all(char in '0123456789abcdef' for char in workspace_id)
+
+
+def get_workspace(workspace_id):
+    """
+    Returns the workspace with the given id, creating it if it does not exist,
+    and removes expired workspaces every now and then.
+    """
+    cleanup_workspaces()
+    workspace = Workspace(os.path.join(config['root'], workspace_id))
+    workspace.touch()
+    return workspace
+
+
+def cleanup_workspaces(force=False):
+    """
+    Removes the workspaces that have not been used for ttl_seconds, unless
+    this was already done less than CLEANUP_INTERVAL_SECONDS ago.
+    """
+    global _last_cleanup
+    now = time.time()
+    with _cleanup_lock:
+        if not force and now - _last_cleanup < CLEANUP_INTERVAL_SECONDS:
+            return
+        _last_cleanup = now
+
+    if not os.path.exists(config['root']):
+        return
+    for workspace_id in os.listdir(config['root']):
+        folder = os.path.join(config['root'], workspace_id)
+        try:
+            if now - os.path.getmtime(folder) > config['ttl_seconds']:
+                shutil.rmtree(folder)
+                logger.info("Removed expired workspace %s", workspace_id)
+        except OSError:
+            # removed by another worker in the meantime
+            pass
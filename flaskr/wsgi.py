@@ -0,0 +1,13 @@
+"""
+Entry point of the server, which starts the candidate workers and loads the
+detector before serving requests. Run it with:
+
+    flask --app flaskr.wsgi run
+
+or with any WSGI server, e.g. gunicorn flaskr.wsgi:app. Importing the flaskr
+package itself starts neither, so the offline tools and the benchmarks only
+load what they use.
+"""
+from . import app, start_workers
+
+start_workers()
@@ -0,0 +1,49 @@
+"""
+Fixtures shared by the tests of the app's routes
+"""
+import io
+
+import pytest
+from PIL import Image
+
+import flaskr
+from flaskr import history
+from flaskr import workspaces
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """
+    Returns a test client of the app, with the workspaces and the poem
+    history in a temporary folder
+    """
+    monkeypatch.setitem(workspaces.config, 'root', \
+                        str(tmp_path / "workspaces"))
+    monkeypatch.setattr(history, '_history', \
+                        history.PoemHistory(str(tmp_path / "history.db")))
+    return flaskr.app.test_client()
+
+
+def image_bytes(image_format='PNG', size=(8, 8)):
+    """
+    Returns a small encoded image
+    """
+    image_file = io.BytesIO()
+    Image.new('RGB', size, (200, 40, 40)).save(image_file, image_format)
+    return image_file.getvalue()
+
+
+def upload(client, *files):
+    """
+    Uploads (bytes, file name) pairs as the files of one request
+    """
+    return client.post('/upload', data={'files' : [(io.BytesIO(data), name) \
+                        for data, name in files]}, \
+                       content_type='multipart/form-data')
+
+
+def client_workspace(client):
+    """
+    Returns the workspace of the session of a test client
+    """
+    return workspaces.get_workspace(client.get_cookie('workspace_id').value)
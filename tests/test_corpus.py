@@ -0,0 +1,40 @@
+import os
+
+import pandas as pd
+
+from flaskr import corpus
+
+
+def write_csv(path, poems):
+    pd.DataFrame({'Title' : [f"Poem {i}" for i in range(len(poems))], \
+                  'Poem' : poems}).to_csv(path, index=False)
+
+
+def build(folder, csv_path):
+    os.makedirs(folder, exist_ok=True)
+    blob_path = os.path.join(folder, 'corpus.blob')
+    offsets_path = os.path.join(folder, 'corpus.offsets.npy')
+    corpus.build_corpus_blob(csv_path, blob_path, offsets_path)
+    return corpus.PoemCorpus(blob_path, offsets_path)
+
+
+def test_corpus_reads_titles_and_poems(tmp_path):
+    write_csv(tmp_path / "poems.csv", ["The sun rose.", "Déjà vu, again."])
+    poem_corpus = build(str(tmp_path), str(tmp_path / "poems.csv"))
+    assert len(poem_corpus) == 2
+    assert poem_corpus.title(1) == "Poem 1"
+    assert poem_corpus.poem(1) == "Déjà vu, again."
+    # temporary files are moved into place
+    assert sorted(os.listdir(tmp_path)) == ['corpus.blob', \
+                                  'corpus.offsets.npy', 'poems.csv']
+
+
+def test_checksum_only_changes_with_the_poems(tmp_path):
+    write_csv(tmp_path / "poems.csv", ["The sun rose.", "The moon set."])
+    first = build(str(tmp_path / "first"), str(tmp_path / "poems.csv"))
+    again = build(str(tmp_path / "again"), str(tmp_path / "poems.csv"))
+    assert first.checksum() == again.checksum()
+
+    write_csv(tmp_path / "poems.csv", ["The sun rose.", "The moon rose."])
+    changed = build(str(tmp_path / "changed"), str(tmp_path / "poems.csv"))
+    assert changed.checksum() != first.checksum()
@@ -0,0 +1,71 @@
+from flaskr import history
+from flaskr.history import PoemHistory
+
+
+def test_pages_follow_the_cursor(tmp_path):
+    poem_history = PoemHistory(str(tmp_path / "history.db"))
+    assert poem_history.page() == ([], None)
+
+    ids = [poem_history.add(f"poem {i}", f"text {i}", created=i) \
+           for i in range(5)]
+    assert poem_history.count() == (5, ids[-1])
+
+    poems, cursor = poem_history.page(limit=2)
+    assert [poem['id'] for poem in poems] == [ids[4], ids[3]]
+    assert cursor == ids[3]
+    poems, cursor = poem_history.page(cursor, limit=2)
+    assert [poem['id'] for poem in poems] == [ids[2], ids[1]]
+    poems, cursor = poem_history.page(cursor, limit=2)
+    assert [poem['name'] for poem in poems] == ["poem 0"]
+    assert cursor is None
+
+    # a last page that is exactly full has no next page
+    poems, cursor = poem_history.page(ids[2], limit=2)
+    assert len(poems) == 2
+    assert cursor is None
+
+
+def test_import_skips_imported_poems(tmp_path):
+    folder = tmp_path / "poems"
+    folder.mkdir()
+    for i in range(3):
+        (folder / f"poem {i}.txt").write_text(f"text {i}")
+    poem_history = PoemHistory(str(tmp_path / "history.db"))
+
+    assert poem_history.import_text_files(str(folder)) == 3
+    assert poem_history.import_text_files(str(folder)) == 0
+    (folder / "poem 3.txt").write_text("text 3")
+    assert poem_history.import_text_files(str(folder)) == 1
+    assert poem_history.count()[0] == 4
+
+
+def test_history_route_pages(client):
+    for i in range(3):
+        history.get_history().add(f"poem {i}", f"text {i}", created=i)
+
+    first_page = client.get('/history?limit=2').get_json()
+    assert [poem['name'] for poem in first_page['poems']] == \
+           ["poem 2", "poem 1"]
+    second_page = client.get(f"/history?limit=2&" \
+                             f"before={first_page['next']}").get_json()
+    assert [poem['name'] for poem in second_page['poems']] == ["poem 0"]
+    assert second_page['next'] is None
+    assert client.get('/history/count').get_json() == {'count' : 3}
+
+
+def test_unchanged_history_pages_are_not_sent_again(client):
+    response = client.get('/history')
+    assert response.status_code == 200
+    assert client.get('/history', headers={'If-None-Match' : \
+                      response.headers['ETag']}).status_code == 304
+
+    history.get_history().add("poem", "text")
+    response = client.get('/history', headers={'If-None-Match' : \
+                          response.headers['ETag']})
+    assert response.status_code == 200
+    assert client.get('/history', headers={'If-None-Match' : \
+                      response.headers['ETag']}).status_code == 304
+
+    count = client.get('/history/count')
+    assert client.get('/history/count', headers={'If-None-Match' : \
+                      count.headers['ETag']}).status_code == 304
@@ -0,0 +1,88 @@
+import time
+import queue
+import threading
+
+import pytest
+
+from flaskr.jobs import JobQueue
+
+
+def wait_for(job):
+    """
+    Waits up to 5 seconds for a job to finish and returns it
+    """
+    deadline = time.time() + 5
+    while job.status in ['queued', 'running'] and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+def test_job_queue_turns_away_jobs_beyond_max_queued():
+    release = threading.Event()
+    jobs = JobQueue(num_workers=1, max_queued=1)
+
+    running = jobs.submit(lambda job: release.wait())
+    while running.status != 'running':
+        time.sleep(0.01)
+    waiting = jobs.submit(lambda job: "done")
+    with pytest.raises(queue.Full):
+        jobs.submit(lambda job: "too many")
+    assert jobs.depth() == 1
+    assert jobs.stats() == {'queued' : 1, 'running' : 1}
+
+    release.set()
+    assert wait_for(waiting).result == "done"
+    assert jobs.stats() == {'queued' : 0, 'running' : 0}
+
+
+def test_job_queue_records_failures():
+    jobs = JobQueue(num_workers=1, max_queued=1)
+    failing = wait_for(jobs.submit(lambda job: 1 / 0))
+    assert failing.status == 'failed'
+    assert failing.result is None
+    assert failing.to_dict()['error'].startswith("ZeroDivisionError")
+
+
+def test_job_queue_keeps_newest_finished_jobs():
+    jobs = JobQueue(num_workers=1, max_queued=3, max_finished=2)
+    finished = [wait_for(jobs.submit(lambda job, i: i, i)) for i in range(3)]
+    assert [job.result for job in finished] == [0, 1, 2]
+    assert jobs.get(finished[0].id) is None
+    assert jobs.get(finished[1].id) is finished[1]
+    assert jobs.get(finished[2].id).to_dict()['result'] == 2
+    assert jobs.get('unknown') is None
+
+
+def test_job_events_end_when_job_finishes():
+    jobs = JobQueue(num_workers=1, max_queued=1)
+
+    def count_to(job, n):
+        for i in range(n):
+            job.publish('step', i)
+        return n
+
+    job = jobs.submit(count_to, 3, events=True)
+    assert list(job.subscribe(timeout=5)) == \
+           [('step', 0), ('step', 1), ('step', 2)]
+    assert job.status == 'done'
+    assert job.result == 3
+
+
+def test_job_events_keep_alive_while_queued():
+    release = threading.Event()
+    jobs = JobQueue(num_workers=1, max_queued=1)
+    jobs.submit(lambda job: release.wait())
+    job = jobs.submit(lambda job: job.publish('poem', "text"), events=True)
+
+    events = job.subscribe(timeout=0.05)
+    assert next(events) is None
+    release.set()
+    assert [item for item in events if item is not None] == \
+           [('poem', "text")]
+
+
+def test_job_without_events_ignores_published_events():
+    jobs = JobQueue(num_workers=1, max_queued=1)
+    job = wait_for(jobs.submit(lambda job: job.publish('poem', "text")))
+    assert job.status == 'done'
+    assert job.events is None
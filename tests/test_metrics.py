@@ -0,0 +1,58 @@
+import os
+
+from flaskr import metrics
+from flaskr import object_detection as od
+
+
+def test_metrics_render_in_prometheus_text_format(monkeypatch):
+    # keep the test metrics out of the app's registry
+    monkeypatch.setattr(metrics, '_registry', [])
+    counter = metrics.Counter('test_events_total', "Events", ['kind'])
+    counter.inc(kind='a')
+    counter.inc(2, kind='a')
+    gauge = metrics.Gauge('test_depth', "Depth")
+    gauge.set(3)
+    histogram = metrics.Histogram('test_seconds', "Seconds", buckets=(1, 5))
+    histogram.observe(0.5)
+    histogram.observe(2)
+
+    assert counter.render() == ["# HELP test_events_total Events", \
+                                "# TYPE test_events_total counter", \
+                                'test_events_total{kind="a"} 3']
+    assert gauge.samples() == ["test_depth 3"]
+    assert histogram.samples() == ['test_seconds_bucket{le="1"} 1', \
+                                   'test_seconds_bucket{le="5"} 2', \
+                                   'test_seconds_bucket{le="+Inf"} 2', \
+                                   "test_seconds_sum 2.5", \
+                                   "test_seconds_count 2"]
+    assert metrics.render().count("# TYPE") == 3
+
+
+def test_metrics_route_reports_request_timings(client):
+    client.get('/history/count')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type == 'text/plain; version=0.0.4; ' \
+                                    'charset=utf-8'
+    text = response.get_data(as_text=True)
+    assert "# TYPE flaskr_request_seconds histogram" in text
+    assert 'flaskr_request_seconds_count{endpoint="count_old_poems"}' in text
+    assert 'flaskr_generation_jobs{state="queued"} 0' in text
+
+
+def test_profiled_block_is_dumped(tmp_path, monkeypatch):
+    monkeypatch.setitem(metrics.config, 'profile_folder', str(tmp_path))
+    with metrics.profiled('test'):
+        sum(range(1000))
+    profiles = os.listdir(tmp_path)
+    assert len(profiles) == 1
+    assert profiles[0].endswith('.prof')
+    assert '-test-' in profiles[0]
+
+
+def test_metrics_route_reports_preprocess_queue_depth(client, monkeypatch):
+    assert "flaskr_preprocess_queue_depth 0" in \
+           client.get('/metrics').get_data(as_text=True)
+    monkeypatch.setattr(od, 'preprocess_queue_depth', lambda: 3)
+    assert "flaskr_preprocess_queue_depth 3" in \
+           client.get('/metrics').get_data(as_text=True)
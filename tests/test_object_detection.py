@@ -0,0 +1,27 @@
+from flaskr.object_detection import aggregate_themes
+
+
+def test_aggregate_themes_orders_by_highest_score():
+    categories = ['__background__', 'dog', 'cat', 'traffic light']
+    image_results = [([1, 2], [0.9, 0.5]), ([1, 3, 3], [0.3, 0.95, 0.2])]
+
+    # dogs score 0.9 at best, however low their other score
+    assert aggregate_themes(image_results, categories) == \
+           ['traffic lights', 'dogs', 'cat']
+    assert aggregate_themes(image_results, categories, max_num_themes=2) == \
+           ['traffic lights', 'dogs']
+
+
+def test_aggregate_themes_pluralizes_repeated_labels():
+    categories = ['__background__', 'dog', 'cat', 'traffic light']
+    assert aggregate_themes([([2], [0.4])], categories) == ['cat']
+    assert aggregate_themes([([2], [0.4]), ([2], [0.6])], categories) == \
+           ['cats']
+    assert aggregate_themes([([3, 3], [0.4, 0.5])], categories) == \
+           ['traffic lights']
+
+
+def test_aggregate_themes_without_objects():
+    categories = ['__background__', 'dog']
+    assert aggregate_themes([], categories) == []
+    assert aggregate_themes([([], [])], categories) == []
@@ -0,0 +1,172 @@
+"""
+Poems are generated on a blank spaCy pipeline over a few hand-built parsed
+sentences, so that no spaCy model or corpus is needed.
+"""
+import pickle
+
+import numpy as np
+import pytest
+import spacy
+from spacy.tokens import Doc
+
+import flaskr
+from flaskr import corpus_index
+from flaskr import lexicon
+from flaskr import nlp_pipeline
+from flaskr import poem_generator as pg
+from flaskr.rng import BlockRandom
+
+# words, tags, dependency labels and head positions of each inspiring sentence
+SENTENCES = [
+    ("the dog chased a small cat .".split(), \
+     ['DT', 'NN', 'VBD', 'DT', 'JJ', 'NN', '.'], \
+     ['det', 'nsubj', 'ROOT', 'det', 'amod', 'dobj', 'punct'], \
+     [1, 2, 2, 5, 5, 2, 2]),
+    ("a bird sang sweetly .".split(), \
+     ['DT', 'NN', 'VBD', 'RB', '.'], \
+     ['det', 'nsubj', 'ROOT', 'advmod', 'punct'], \
+     [1, 2, 2, 2, 2]),
+    ("the happy cat watched the sad bird .".split(), \
+     ['DT', 'JJ', 'NN', 'VBD', 'DT', 'JJ', 'NN', '.'], \
+     ['det', 'amod', 'nsubj', 'ROOT', 'det', 'amod', 'dobj', 'punct'], \
+     [2, 2, 3, 3, 6, 6, 3, 3]),
+    ("the old tree stood by the quiet river .".split(), \
+     ['DT', 'JJ', 'NN', 'VBD', 'IN', 'DT', 'JJ', 'NN', '.'], \
+     ['det', 'amod', 'nsubj', 'ROOT', 'prep', 'det', 'amod', 'pobj', \
+      'punct'], \
+     [2, 2, 3, 3, 3, 7, 7, 4, 3]),
+    ("a lonely dog ran to the dark river .".split(), \
+     ['DT', 'JJ', 'NN', 'VBD', 'IN', 'DT', 'JJ', 'NN', '.'], \
+     ['det', 'amod', 'nsubj', 'ROOT', 'prep', 'det', 'amod', 'pobj', \
+      'punct'], \
+     [2, 2, 3, 3, 3, 7, 7, 4, 3]),
+]
+
+THEMES = ['dog', 'river']
+
+
+class InProcessPool():
+    """
+    Stands in for the candidate pool: runs every candidate in this process,
+    last one first, all on the same worker copy of the generator
+    """
+    def imap_unordered(self, func, tasks):
+        return InProcessResults([func(task) for task in reversed(tasks)])
+
+
+class InProcessResults():
+    """
+    Stands in for the results of imap_unordered
+    """
+    def __init__(self, results):
+        self.results = iter(results)
+
+
+    def next(self, timeout=None):
+        return next(self.results)
+
+
+@pytest.fixture
+def generator_factory(monkeypatch):
+    """
+    Returns a function making poem generators that have ingested the
+    hand-built sentences, on a blank pipeline and an empty lexicon
+    """
+    nlp = spacy.blank('en')
+    monkeypatch.setattr(nlp_pipeline, '_nlp', nlp)
+    monkeypatch.setattr(lexicon, '_lexicon', lexicon.Lexicon([], [], \
+                        np.zeros(0, dtype=np.int16), \
+                        np.zeros(0, dtype=np.float64), \
+                        np.zeros(0, dtype=np.float64)))
+    monkeypatch.setattr(corpus_index, 'get_index', lambda nlp: None)
+    monkeypatch.setattr(pg, 'parse_poem_sentences', lambda texts: \
+        [[Doc(nlp.vocab, words=words, tags=tags, deps=deps, heads=heads) \
+          for words, tags, deps, heads in SENTENCES] for text in texts])
+
+    def make_generator(seed):
+        generator = pg.PoemGenerator(seed)
+        generator.inspiring_poems = {'hand-built' : ""}
+        generator.parse_inspiring_poems()
+        generator.parse_themes(THEMES)
+        return generator
+
+    return make_generator
+
+
+def poem_text(generator, poem):
+    poem = generator.reformat_poem(poem)
+    return poem.name, poem.text
+
+
+def test_generation_is_deterministic(generator_factory):
+    texts = []
+    for attempt in range(2):
+        generator = generator_factory(7)
+        poem = generator.generate_candidates(3, 4, THEMES)
+        texts.append(poem_text(generator, poem))
+    assert texts[0] == texts[1]
+    assert len(texts[0][1]) > 0
+
+
+def test_generation_depends_on_seed(generator_factory):
+    texts = set()
+    for seed in range(5):
+        generator = generator_factory(seed)
+        poem = generator.generate_revised_poem(4, THEMES)
+        texts.add(poem_text(generator, poem))
+    assert len(texts) > 1
+
+
+def test_pickled_generator_generates_same_candidate(generator_factory):
+    # candidate workers generate from a pickled copy of the generator
+    generator = generator_factory(11)
+    generator.get_score_indexes()
+    copy = pickle.loads(pickle.dumps(generator))
+    generator.rng.seed(5)
+    copy.rng.seed(5)
+    assert poem_text(generator, generator.generate_revised_poem(4, THEMES)) \
+           == poem_text(copy, copy.generate_revised_poem(4, THEMES))
+
+
+def test_seed_gives_same_poem_with_or_without_pool(generator_factory, \
+                                                   monkeypatch):
+    serial_poems = []
+    for seed in range(20):
+        generator = generator_factory(seed)
+        serial_poems.append(poem_text(generator, \
+                            generator.generate_candidates(4, 4, THEMES)))
+
+    monkeypatch.setattr(pg, '_candidate_pool', InProcessPool())
+    monkeypatch.setattr(pg, '_candidate_pool_size', 2)
+    monkeypatch.setattr(pg, '_worker_generator', None)
+    pooled_poems = []
+    for seed in range(20):
+        generator = generator_factory(seed)
+        pooled_poems.append(poem_text(generator, \
+                            generator.generate_candidates(4, 4, THEMES)))
+    assert pooled_poems == serial_poems
+
+
+def test_candidate_does_not_depend_on_earlier_candidates(generator_factory):
+    generator = generator_factory(3)
+    fresh_poems = []
+    for seed in range(20):
+        poem = pickle.loads(pickle.dumps(generator)).generate_seeded_poem( \
+                                                        seed, 4, THEMES)
+        fresh_poems.append((poem.name, poem.text))
+
+    shared_copy = pickle.loads(pickle.dumps(generator))
+    shared_poems = []
+    for seed in range(20):
+        poem = shared_copy.generate_seeded_poem(seed, 4, THEMES)
+        shared_poems.append((poem.name, poem.text))
+    assert shared_poems == fresh_poems
+
+
+@pytest.mark.parametrize('seed, expected', [(-1, 2**32 - 1), (7, 7), \
+                                            (2**40 + 7, 7)])
+def test_requested_seeds_are_valid_generator_seeds(seed, expected):
+    with flaskr.app.test_request_context(f"/generate/stream?seed={seed}"):
+        assert flaskr.generation_settings(1)[2] == expected
+    # seeds out of range used to fail once the job started
+    BlockRandom(expected).random()
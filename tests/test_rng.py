@@ -0,0 +1,36 @@
+import pytest
+
+from flaskr.rng import BlockRandom
+
+
+def test_block_random_repeats_sequence_for_seed():
+    first = BlockRandom(42, block_size=8)
+    second = BlockRandom(42, block_size=8)
+    draws = [first.random() for i in range(20)]
+    assert draws == [second.random() for i in range(20)]
+    assert first.seed_value == 42
+
+    first.seed(42)
+    assert [first.random() for i in range(20)] == draws
+    assert BlockRandom(43).random() != draws[0]
+
+
+def test_block_random_bounds():
+    rng = BlockRandom(0)
+    draws = [rng.randint(3, 5) for i in range(500)]
+    assert set(draws) == {3, 4, 5}
+    assert all(0 <= rng.randrange(7) < 7 for i in range(500))
+    assert 0 <= rng.spawn_seed() < 2**32
+
+
+def test_block_random_choice_and_sample():
+    rng = BlockRandom(0)
+    items = list(range(10))
+    assert rng.choice(items) in items
+    with pytest.raises(IndexError):
+        rng.choice([])
+
+    sample = rng.sample(items, 4)
+    assert len(sample) == 4
+    assert len(set(sample)) == 4
+    assert sorted(rng.sample(items, 20)) == items
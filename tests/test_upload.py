@@ -0,0 +1,70 @@
+import flaskr
+from flaskr import jobs
+from flaskr import object_detection as od
+from flaskr import workspaces
+from .conftest import client_workspace, image_bytes, upload
+
+
+def detected(images_bytes):
+    """
+    Stands in for the detector: one dog in every image
+    """
+    return [([1], [0.9]) for image in images_bytes]
+
+
+def test_images_are_judged_by_their_leading_bytes(client, monkeypatch):
+    monkeypatch.setattr(od, 'detect_image_results', detected)
+    response = upload(client, (image_bytes(), "photo.txt"), \
+                      (image_bytes('JPEG'), "photo"), \
+                      (b"GIF89a" + bytes(32), "animation.png"), \
+                      (b"not an image", "notes.jpg"))
+    assert response.status_code == 200
+    assert b"Skipped 2 file(s)" in response.data
+
+    workspace = client_workspace(client)
+    assert workspace.wait_for_detections()
+    assert len(workspace.read_image_results()) == 2
+
+
+def test_images_with_too_many_pixels_are_skipped(client, monkeypatch):
+    monkeypatch.setattr(od, 'detect_image_results', detected)
+    monkeypatch.setitem(od.config, 'max_image_pixels', 100)
+    response = upload(client, (image_bytes(size=(20, 20)), "large.png"))
+    assert b"Skipped 1 file(s)" in response.data
+    assert od.check_image(image_bytes(size=(10, 10))) == 'png'
+
+
+def test_uploads_larger_than_the_limit_are_refused(client, monkeypatch):
+    monkeypatch.setitem(flaskr.app.config, 'MAX_CONTENT_LENGTH', 1024)
+    response = upload(client, (bytes(4096), "large.png"))
+    assert response.status_code == 413
+    assert b"Upload at most 0 MB at once" in response.data
+
+
+def test_uploads_are_refused_while_detection_queue_is_full(client, \
+                                                            monkeypatch):
+    # a queue without workers, already holding as many uploads as it can
+    full_jobs = jobs.JobQueue(num_workers=0, max_queued=1)
+    full_jobs.submit(lambda job: None)
+    monkeypatch.setattr(flaskr, 'detection_jobs', full_jobs)
+
+    response = upload(client, (image_bytes(), "photo.png"))
+    assert response.status_code == 503
+    assert b"Too many images are being processed" in response.data
+    workspace = client_workspace(client)
+    assert workspace.wait_for_detections()
+
+
+def test_undecodable_images_are_left_out_of_the_results(tmp_path, \
+                                                         monkeypatch):
+    monkeypatch.setattr(od, 'detect_image_results', lambda images_bytes: \
+                        [None, ([2], [0.7])])
+    workspace = workspaces.Workspace(str(tmp_path / "workspace"))
+    detection_id = workspace.start_detection()
+
+    job = jobs.Job(flaskr.run_detection_job, ())
+    assert flaskr.run_detection_job(job, workspace, detection_id, \
+                                    [b"truncated", b"valid"]) == \
+           {'images' : 1, 'skipped' : 1}
+    assert workspace.read_image_results() == [([2], [0.7])]
+    assert workspace.wait_for_detections()
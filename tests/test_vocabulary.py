@@ -0,0 +1,57 @@
+import random
+
+from flaskr.vocabulary import IndexedSet, ScoreIndex
+
+
+def test_indexed_set_keeps_items_once_in_order():
+    words = IndexedSet(['sun', 'moon', 'sun'])
+    assert len(words) == 2
+    assert list(words) == ['sun', 'moon']
+    assert words[1] == 'moon'
+    assert 'sun' in words
+    assert 'star' not in words
+
+
+def test_indexed_set_add_returns_whether_added():
+    words = IndexedSet()
+    assert words.add('star')
+    assert not words.add('star')
+    assert words.add('moon')
+    assert list(words) == ['star', 'moon']
+    assert words.positions == {'star' : 0, 'moon' : 1}
+
+
+def test_indexed_set_random_choice():
+    words = IndexedSet(['sun', 'moon', 'star'])
+    chosen = {random.Random(seed).choice(words) for seed in range(50)}
+    assert chosen == {'sun', 'moon', 'star'}
+
+
+def test_score_index_sorts_scored_words_of_each_tag():
+    categories = {'JJ' : IndexedSet(['happy', 'sad', 'new']), \
+                  'NN' : IndexedSet(['joy'])}
+    index = ScoreIndex(categories, {'sad' : -0.5, 'happy' : 0.8, 'joy' : 0.3})
+    # words without a score are left out
+    assert index.words == {'JJ' : ['sad', 'happy'], 'NN' : ['joy']}
+    assert index.scores['JJ'].tolist() == [-0.5, 0.8]
+
+
+def test_score_index_ranges_exclude_equal_scores():
+    categories = {'JJ' : IndexedSet(['sad', 'dull', 'calm', 'happy'])}
+    scores = {'sad' : -0.5, 'dull' : 0.0, 'calm' : 0.0, 'happy' : 0.8}
+    index = ScoreIndex(categories, scores)
+
+    start, end = index.range_above('JJ', 0.0)
+    assert index.words['JJ'][start:end] == ['happy']
+    start, end = index.range_below('JJ', 0.0)
+    assert index.words['JJ'][start:end] == ['sad']
+    start, end = index.range_above('JJ', -1.0)
+    assert index.words['JJ'][start:end] == ['sad', 'dull', 'calm', 'happy']
+    assert index.range_below('JJ', -0.5) == (0, 0)
+    assert index.range_above('JJ', 0.8) == (4, 4)
+
+
+def test_score_index_ranges_of_unknown_tags_are_empty():
+    index = ScoreIndex({'JJ' : IndexedSet(['sad'])}, {'sad' : -0.5})
+    assert index.range_above('NN', 0.0) == (0, 0)
+    assert index.range_below('NN', 0.0) == (0, 0)
@@ -0,0 +1,58 @@
+import threading
+
+from flaskr import object_detection as od
+from flaskr import workspaces
+from .conftest import client_workspace, image_bytes, upload
+
+
+def test_sessions_get_separate_workspaces(client, monkeypatch):
+    monkeypatch.setattr(od, 'detect_image_results', lambda images_bytes: \
+                        [([1], [0.9]) for image in images_bytes])
+    other_client = client.application.test_client()
+
+    assert upload(client, (image_bytes(), "a.png")).status_code == 200
+    assert upload(other_client, (image_bytes('JPEG'), "b.jpg"), \
+                  (image_bytes(), "c.png")).status_code == 200
+
+    first, second = client_workspace(client), client_workspace(other_client)
+    assert first.folder != second.folder
+    assert first.wait_for_detections() and second.wait_for_detections()
+    assert first.read_image_results() == [([1], [0.9])]
+    assert second.read_image_results() == [([1], [0.9]), ([1], [0.9])]
+
+    first.clear()
+    assert first.read_image_results() == []
+    assert len(second.read_image_results()) == 2
+
+
+def test_workspace_cookie_is_refreshed_on_every_use(client, monkeypatch):
+    monkeypatch.setattr(od, 'detect_image_results', lambda images_bytes: \
+                        [([1], [0.9]) for image in images_bytes])
+    response = upload(client, (image_bytes(), "a.png"))
+    workspace_id = client.get_cookie('workspace_id').value
+    assert 'Max-Age' in response.headers['Set-Cookie']
+
+    response = upload(client, (image_bytes(), "a.png"))
+    assert client.get_cookie('workspace_id').value == workspace_id
+    assert response.headers['Set-Cookie'].startswith(f"workspace_id=" \
+                                                     f"{workspace_id};")
+
+
+def test_invalid_workspace_cookie_is_replaced(client, monkeypatch):
+    monkeypatch.setattr(od, 'detect_image_results', lambda images_bytes: [])
+    client.set_cookie('workspace_id', "../../etc")
+    upload(client, (image_bytes(), "a.png"))
+    assert workspaces.is_valid_id(client.get_cookie('workspace_id').value)
+
+
+def test_concurrent_uploads_keep_every_result(tmp_path):
+    workspace = workspaces.Workspace(str(tmp_path / "workspace"))
+    workspace.touch()
+    threads = [threading.Thread(target=workspace.add_image_results, \
+                                args=([([i], [0.5])],)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(workspace.read_image_results()) == \
+           [([i], [0.5]) for i in range(20)]